@@ -0,0 +1,274 @@
+import asyncio
+import base64
+import collections
+import getpass
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+USERS_PATH = "users.json"  # username -> password hash record
+SECRET_PATH = "session.key"  # signs session tokens; shared by all workers, survives restarts
+SCRYPT_N = 2 ** 14  # ~50ms and 16MB per hash
+SCRYPT_R = 8
+SCRYPT_P = 1
+HASH_WORKERS = 4  # hashlib releases the GIL, so threads hash in parallel
+TOKEN_TTL = 60 * 60  # seconds a session token can be used to resume
+CACHE_TTL = 5 * 60  # seconds a verified password is remembered
+CACHE_SIZE = 10000
+
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """Salted scrypt record: scrypt$n$r$p$salt$hash"""
+    salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024)
+    return f"scrypt${n}${r}${p}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(record, password):
+    """Check a password against a hash record; slow on purpose, run it off the loop"""
+    try:
+        scheme, n, r, p, salt, expected = record.split("$")
+        n, r, p = int(n), int(r), int(p)
+    except ValueError:
+        return False
+    if scheme != "scrypt":
+        return False
+    digest = hashlib.scrypt(
+        password.encode(), salt=bytes.fromhex(salt), n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024
+    )
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class CredentialCache:
+    """Recently verified passwords, keyed by a fast HMAC so no plaintext is kept"""
+
+    def __init__(self, key, ttl=CACHE_TTL, max_size=CACHE_SIZE):
+        self.key = key
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # username -> (mac, hash record, expires)
+
+    def _mac(self, username, password):
+        return hmac.new(self.key, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+
+    def check(self, username, password, record):
+        entry = self.entries.get(username)
+        if entry is None:
+            return False
+        mac, cached_record, expires = entry
+        if expires < time.monotonic() or cached_record != record:
+            del self.entries[username]
+            return False
+        return hmac.compare_digest(mac, self._mac(username, password))
+
+    def add(self, username, password, record):
+        self.entries[username] = (self._mac(username, password), record, time.monotonic() + self.ttl)
+        self.entries.move_to_end(username)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def forget(self, username):
+        self.entries.pop(username, None)
+
+
+class Authenticator:
+    """File-backed users, password checks on a thread pool, and signed session tokens"""
+
+    def __init__(self, users_path=USERS_PATH, secret_path=SECRET_PATH, workers=HASH_WORKERS,
+                 token_ttl=TOKEN_TTL, cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE):
+        self.users_path = users_path
+        self.secret_path = secret_path
+        self.token_ttl = token_ttl
+        self.executor = ThreadPoolExecutor(workers, "auth")
+        self.users = {}  # username -> hash record
+        self.extra = {}  # accounts that only live in memory (bench users)
+        self.mtime = None
+        self.secret = None
+        self.cache = None
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.hashes = 0  # full password checks
+        self.cache_hits = 0
+        self.resumes = 0
+        self.failures = 0
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _load_secret(self):
+        try:
+            with open(self.secret_path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            secret = os.urandom(32)
+            # Another worker may be creating it at the same moment; first one wins
+            try:
+                fd = os.open(self.secret_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                return self._load_secret()
+            with os.fdopen(fd, "wb") as f:
+                f.write(secret)
+            return secret
+
+    def _load_users(self, defaults):
+        if not os.path.exists(self.users_path) and defaults:
+            # First start: hash the built-in accounts into the user file (unless another worker just did)
+            save_users(self.users_path, {name: hash_password(pw) for name, pw in defaults.items()}, replace=False)
+        try:
+            mtime = os.stat(self.users_path).st_mtime
+            with open(self.users_path) as f:
+                return json.load(f), mtime
+        except FileNotFoundError:
+            return {}, None
+
+    async def start(self, defaults=None):
+        """Load the signing key and user file, creating them on first run"""
+        self.secret = await self._run(self._load_secret)
+        self.cache = CredentialCache(self.secret, self.cache_ttl, self.cache_size)
+        self.users, self.mtime = await self._run(self._load_users, defaults)
+
+    async def _refresh(self):
+        """Pick up edits to the user file (python auth.py add/remove)"""
+        try:
+            mtime = os.stat(self.users_path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime != self.mtime:
+            self.users, self.mtime = await self._run(self._load_users, None)
+
+    def add_memory_users(self, names, password, n=SCRYPT_N):
+        """Accounts that aren't written to the user file; they share one hash record"""
+        record = hash_password(password, n=n)
+        for name in names:
+            self.extra[name] = record
+
+    def record(self, username):
+        return self.users.get(username) or self.extra.get(username)
+
+    async def login(self, username, password):
+        """True if the password is right; served from the cache when recently verified"""
+        if not isinstance(username, str) or not isinstance(password, str):
+            return False
+        await self._refresh()
+        record = self.record(username)
+        if record is None:
+            self.failures += 1
+            return False
+        if self.cache.check(username, password, record):
+            self.cache_hits += 1
+            return True
+        self.hashes += 1
+        if await self._run(verify_password, record, password):
+            self.cache.add(username, password, record)
+            return True
+        self.failures += 1
+        return False
+
+    def _binding(self, record):
+        """Short MAC of a hash record; a token carries it so it dies with the password, without revealing the hash"""
+        return _b64(hmac.new(self.secret, record.encode(), hashlib.sha256).digest()[:12])
+
+    def issue(self, username):
+        """Signed token that lets username resume without a password until it expires"""
+        payload = _b64(json.dumps({
+            "u": username,
+            "exp": int(time.time()) + self.token_ttl,
+            "h": self._binding(self.record(username))  # changing the password invalidates old tokens
+        }).encode())
+        signature = _b64(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest())
+        return f"{payload}.{signature}"
+
+    async def resume(self, token):
+        """Username for a valid, unexpired token, else None; no password hashing involved
+
+        The user file is re-read first if it changed, so removing a user or
+        changing their password also ends their outstanding tokens.
+        """
+        try:
+            payload, signature = token.split(".")
+            expected = _b64(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest())
+            if not hmac.compare_digest(signature, expected):
+                raise ValueError("bad signature")
+            claims = json.loads(_unb64(payload))
+            username = claims["u"]
+            await self._refresh()
+            record = self.record(username)
+            if (claims["exp"] < time.time() or record is None
+                    or not hmac.compare_digest(self._binding(record), claims["h"])):
+                raise ValueError("expired")
+        except (AttributeError, KeyError, TypeError, ValueError):
+            self.failures += 1
+            return None
+        self.resumes += 1
+        return username
+
+    def stats(self):
+        return {
+            "hashes": self.hashes,
+            "cache_hits": self.cache_hits,
+            "resumes": self.resumes,
+            "failures": self.failures
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def save_users(path, users, replace=True):
+    """Write the user file atomically; with replace=False an existing file is left alone"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(users, f, indent=2, sort_keys=True)
+    if replace:
+        os.replace(tmp, path)
+        return
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp)
+
+
+def main(args):
+    """python auth.py add <username> | remove <username> | list"""
+    try:
+        with open(USERS_PATH) as f:
+            users = json.load(f)
+    except FileNotFoundError:
+        users = {}
+
+    if len(args) == 2 and args[0] == "add":
+        password = getpass.getpass(f"Password for {args[1]}: ")
+        users[args[1]] = hash_password(password)
+        save_users(USERS_PATH, users)
+        print(f"Saved {args[1]}")
+    elif len(args) == 2 and args[0] == "remove":
+        if users.pop(args[1], None) is None:
+            print(f"No such user: {args[1]}")
+            return 1
+        save_users(USERS_PATH, users)
+        print(f"Removed {args[1]}")
+    elif args == ["list"]:
+        for name in sorted(users):
+            print(name)
+    else:
+        print(main.__doc__)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
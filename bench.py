@@ -0,0 +1,524 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import time
+import websockets
+import codec as codecs
+import compression
+from transfer import is_chunk, iter_chunks, new_transfer_id, pack_chunk, unpack_chunk
+
+# Headless load generator for server.py. Simulated users are bench0..benchN-1,
+# which the server creates when started with --bench-users N.
+
+BENCH_PASSWORD = "bench"
+CHAT_PREFIX = "bench:"  # chat body is CHAT_PREFIX + send timestamp
+MAX_SAMPLES = 200000  # latency samples kept per process
+PING_INTERVAL = 20  # protocol pings, as client.py sends them; they keep idle users under the server's idle timeout
+
+
+def percentiles(values):
+    """count/mean/p50/p90/p99/max in milliseconds"""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    n = len(values)
+    pick = lambda p: values[min(n - 1, int(n * p))] * 1000
+    return {
+        "count": n,
+        "mean": sum(values) / n * 1000,
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": values[-1] * 1000
+    }
+
+
+class Stats:
+    """Raw samples collected by one load process"""
+
+    def __init__(self):
+        self.connect = []  # seconds from connect to welcome
+        self.auth_failures = 0
+        self.errors = 0
+        self.sent = 0
+        self.received = 0  # messages, counting each one inside a batch
+        self.frames = 0  # websocket frames
+        self.latency = []  # chat send -> receive, seconds
+        self.latency_seen = 0
+        self.heartbeat = []  # heartbeat round trips, seconds
+        self.uploads = []  # (bytes, seconds)
+        self.downloads = []  # (bytes, seconds)
+
+    def add_latency(self, value):
+        self.latency_seen += 1
+        if len(self.latency) < MAX_SAMPLES:
+            self.latency.append(value)
+        else:
+            # Reservoir sampling keeps the percentiles honest on long runs
+            i = random.randrange(self.latency_seen)
+            if i < MAX_SAMPLES:
+                self.latency[i] = value
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class BenchUser:
+    """One simulated client speaking the chat protocol"""
+
+    def __init__(self, name, config, stats):
+        self.name = name
+        self.config = config
+        self.stats = stats
+        self.websocket = None
+        self.codec = codecs.JSON
+        self.waiters = {}  # (type, id) -> future
+        self.heartbeat_sent = None
+
+    def expect(self, msg_type, key=None):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[(msg_type, key)] = future
+        return future
+
+    def resolve(self, msg_type, key, value):
+        future = self.waiters.pop((msg_type, key), None)
+        if future and not future.done():
+            future.set_result(value)
+
+    async def send(self, message):
+        await self.websocket.send(self.codec.encode(message))
+
+    async def connect(self):
+        start = time.perf_counter()
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        policy = compression.CompressionPolicy(enabled=self.config["compression"])
+        self.websocket = await websockets.connect(
+            self.config["url"], ssl=ssl_context, ping_interval=PING_INTERVAL, max_size=None,
+            compression=None, extensions=policy.client_extensions()
+        )
+        await self.websocket.send(codecs.JSON.encode({
+            "type": "auth",
+            "username": self.name,
+            "password": BENCH_PASSWORD,
+            "codecs": [self.config["codec"]],
+            "batch": self.config["batch"]
+        }))
+        welcome = codecs.decode(await self.websocket.recv())
+        if welcome.get("type") != "welcome":
+            self.stats.auth_failures += 1
+            await self.websocket.close()
+            return False
+        self.codec = codecs.CODECS.get(welcome.get("codec"), codecs.JSON)
+        self.stats.connect.append(time.perf_counter() - start)
+        return True
+
+    async def receive(self):
+        """Read every frame, timing chat fan-out and resolving waiters"""
+        downloaded = {}  # download_id -> bytes so far
+        async for frame in self.websocket:
+            if is_chunk(frame):
+                download_id, _, data = unpack_chunk(frame)
+                downloaded[download_id] = downloaded.get(download_id, 0) + len(data)
+                continue
+
+            self.stats.frames += 1
+            message = codecs.decode(frame)
+            if message.get("type") == "batch":
+                for item in message.get("messages", []):
+                    self.handle(item, downloaded)
+            else:
+                self.handle(message, downloaded)
+
+    def handle(self, message, downloaded):
+        """Process one decoded message"""
+        msg_type = message.get("type")
+        self.stats.received += 1
+
+        if msg_type == "chat":
+            body = message.get("message", "")
+            if body.startswith(CHAT_PREFIX):
+                self.stats.add_latency(time.time() - float(body[len(CHAT_PREFIX):]))
+        elif msg_type == "heartbeat_ack" and self.heartbeat_sent:
+            self.stats.heartbeat.append(time.perf_counter() - self.heartbeat_sent)
+            self.heartbeat_sent = None
+        elif msg_type == "upload_ready":
+            self.resolve("upload_ready", message.get("upload_id"), message)
+        elif msg_type == "file_shared" and message.get("from") == self.name:
+            self.resolve("file_shared", None, message)
+        elif msg_type == "download_complete":
+            download_id = message.get("download_id")
+            self.resolve("download_complete", download_id, downloaded.pop(download_id, 0))
+
+    async def chat_loop(self, deadline):
+        interval = self.config["chat_interval"]
+        await asyncio.sleep(random.uniform(0, interval))
+        while time.time() < deadline:
+            await self.send({"type": "chat", "message": f"{CHAT_PREFIX}{time.time()}"})
+            self.stats.sent += 1
+            await asyncio.sleep(random.expovariate(1 / interval))
+
+    async def heartbeat_loop(self, deadline):
+        interval = self.config["heartbeat_interval"]
+        await asyncio.sleep(random.uniform(0, interval))
+        while time.time() < deadline:
+            self.heartbeat_sent = time.perf_counter()
+            await self.send({"type": "heartbeat"})
+            await asyncio.sleep(interval)
+
+    async def transfer(self, path, size):
+        """Upload a file with the streamed protocol, then download it back"""
+        upload_id = new_transfer_id()
+        shared = self.expect("file_shared")
+        ready = self.expect("upload_ready", upload_id)
+        start = time.perf_counter()
+        await self.send({
+            "type": "upload_start",
+            "upload_id": upload_id,
+            "filename": os.path.basename(path),
+            "size": size
+        })
+        await ready
+        if compression.incompressible(path):
+            compression.send_raw(self.websocket, upload_id)
+        for offset, chunk in iter_chunks(path):
+            await self.websocket.send(pack_chunk(upload_id, offset, chunk))
+        file_id = (await shared)["file_id"]
+        self.stats.uploads.append((size, time.perf_counter() - start))
+
+        download_id = new_transfer_id()
+        done = self.expect("download_complete", download_id)
+        start = time.perf_counter()
+        await self.send({
+            "type": "download_request",
+            "file_id": file_id,
+            "download_id": download_id,
+            "offset": 0
+        })
+        received = await done
+        self.stats.downloads.append((received, time.perf_counter() - start))
+
+
+async def run_load(config, names, file_users):
+    """Connect every user in names, generate traffic until the deadline, return stats"""
+    stats = Stats()
+    users = [BenchUser(name, config, stats) for name in names]
+
+    # Connect in bounded batches so the TLS handshakes don't all pile up at once
+    connect_start = time.perf_counter()
+    semaphore = asyncio.Semaphore(config["connect_concurrency"])
+
+    async def connect(user):
+        async with semaphore:
+            try:
+                return await user.connect()
+            except Exception:
+                stats.errors += 1
+                return False
+
+    results = await asyncio.gather(*(connect(user) for user in users))
+    connect_elapsed = time.perf_counter() - connect_start
+    users = [user for user, ok in zip(users, results) if ok]
+
+    deadline = time.time() + config["duration"]
+    tasks = []
+    for user in users:
+        tasks.append(asyncio.create_task(user.receive()))
+        if not config["idle"]:
+            tasks.append(asyncio.create_task(user.chat_loop(deadline)))
+            tasks.append(asyncio.create_task(user.heartbeat_loop(deadline)))
+
+    # File transfers run alongside the chat traffic
+    transfers = []
+    if file_users and users and not config["idle"]:
+        path = f"bench_{os.getpid()}.zip"  # random bytes, as incompressible as a real zip
+        with open(path, "wb") as f:
+            f.write(os.urandom(config["file_size"]))
+        transfers = [
+            asyncio.create_task(user.transfer(path, config["file_size"]))
+            for user in users[:file_users]
+        ]
+
+    await asyncio.sleep(max(0, deadline - time.time()))
+    for result in await asyncio.gather(*transfers, return_exceptions=True):
+        if isinstance(result, Exception):
+            stats.errors += 1
+    if transfers:
+        os.remove(path)
+
+    # Give in-flight chat a moment to arrive before closing
+    await asyncio.sleep(config["drain"])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*(user.websocket.close() for user in users), return_exceptions=True)
+
+    result = stats.to_dict()
+    result["connected"] = len(users)
+    result["connect_elapsed"] = connect_elapsed
+    return result
+
+
+def load_process(config, names, file_users, queue):
+    """Entry point for one extra load-generating process"""
+    queue.put(asyncio.run(run_load(config, names, file_users)))
+
+
+def process_tree(pid):
+    """pid and all of its descendants (Linux /proc)"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def sample_usage(pid):
+    """(cpu seconds, rss bytes) summed over a process tree"""
+    ticks = os.sysconf("SC_CLK_TCK")
+    page = os.sysconf("SC_PAGE_SIZE")
+    cpu, rss = 0.0, 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            rss += int(fields[21]) * page
+        except (OSError, IndexError, ValueError):
+            pass
+    return cpu, rss
+
+
+async def monitor(pid, samples, stop):
+    """Sample server CPU% and RSS once a second"""
+    last_cpu, _ = sample_usage(pid)
+    last_time = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(1)
+        cpu, rss = sample_usage(pid)
+        now = time.perf_counter()
+        samples.append({"cpu_percent": (cpu - last_cpu) / (now - last_time) * 100, "rss": rss})
+        last_cpu, last_time = cpu, now
+
+
+def merge(results):
+    """Combine per-process raw samples into one report"""
+    merged = Stats().to_dict()
+    merged["connected"] = 0
+    merged["connect_elapsed"] = 0.0
+    for result in results:
+        for key, value in result.items():
+            if isinstance(value, list):
+                merged[key].extend(value)
+            elif key == "connect_elapsed":
+                merged[key] = max(merged[key], value)
+            else:
+                merged[key] += value
+    return merged
+
+
+def throughput(transfers):
+    total_bytes = sum(size for size, _ in transfers)
+    total_time = sum(seconds for _, seconds in transfers)
+    return {
+        "count": len(transfers),
+        "mb_per_second": total_bytes / total_time / (1024 * 1024) if total_time else 0
+    }
+
+
+def summarize(config, merged, usage, rss_baseline):
+    report = {
+        "timestamp": time.time(),
+        "config": config,
+        "connected": merged["connected"],
+        "auth_failures": merged["auth_failures"],
+        "errors": merged["errors"],
+        "connect_per_second": merged["connected"] / merged["connect_elapsed"] if merged["connect_elapsed"] else 0,
+        "connect_ms": percentiles(merged["connect"]),
+        "chat_sent": merged["sent"],
+        "messages_received": merged["received"],
+        "frames_received": merged["frames"],
+        "fanout_latency_ms": percentiles(merged["latency"]),
+        "heartbeat_rtt_ms": percentiles(merged["heartbeat"]),
+        "upload": throughput(merged["uploads"]),
+        "download": throughput(merged["downloads"])
+    }
+    if usage:
+        report["server"] = {
+            "cpu_percent_mean": sum(s["cpu_percent"] for s in usage) / len(usage),
+            "cpu_percent_max": max(s["cpu_percent"] for s in usage),
+            "rss_baseline": rss_baseline,
+            "rss_max": max(s["rss"] for s in usage),
+            # What connecting the users added, not the interpreter and imports
+            "rss_per_connection": (max(s["rss"] for s in usage) - rss_baseline) / max(1, merged["connected"])
+        }
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Print regressions against a previous run; returns True if any were found"""
+    checks = [
+        ("fanout_latency_ms", "p99", True),
+        ("heartbeat_rtt_ms", "p99", True),
+        ("connect_ms", "p99", True),
+        ("upload", "mb_per_second", False),
+        ("download", "mb_per_second", False)
+    ]
+    regressed = False
+    for section, field, lower_is_better in checks:
+        old = baseline.get(section, {}).get(field)
+        new = report.get(section, {}).get(field)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = change > tolerance if lower_is_better else change < -tolerance
+        flag = "REGRESSION" if worse else "ok"
+        print(f"{section}.{field}: {old:.2f} -> {new:.2f} ({change:+.0%}) {flag}")
+        regressed = regressed or worse
+    return regressed
+
+
+def wait_for_port(host, port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+async def run(config, server_pid):
+    names = [f"bench{i}" for i in range(config["users"])]
+    processes = max(1, config["processes"])
+    usage, stop = [], asyncio.Event()
+    sampler = None
+    rss_baseline = 0
+    if server_pid and os.path.isdir("/proc"):
+        _, rss_baseline = sample_usage(server_pid)
+        sampler = asyncio.create_task(monitor(server_pid, usage, stop))
+
+    # Extra processes take an even share of the users; this process runs the first share
+    shares = [names[i::processes] for i in range(processes)]
+    file_shares = [config["file_users"] // processes + (1 if i < config["file_users"] % processes else 0)
+                   for i in range(processes)]
+    # Spawn rather than fork: this process already has a running event loop
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    workers = [
+        context.Process(target=load_process, args=(config, shares[i], file_shares[i], queue))
+        for i in range(1, processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    results = [await run_load(config, shares[0], file_shares[0])]
+    for _ in workers:
+        results.append(await asyncio.get_running_loop().run_in_executor(None, queue.get))
+    for worker in workers:
+        worker.join()
+
+    stop.set()
+    if sampler:
+        await sampler
+    return summarize(config, merge(results), usage, rss_baseline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the chat server")
+    parser.add_argument("--url", default="wss://localhost:8765")
+    parser.add_argument("--users", type=int, default=200, help="simulated users")
+    parser.add_argument("--processes", type=int, default=1, help="load-generating processes")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of traffic")
+    parser.add_argument("--chat-interval", type=float, default=5, help="mean seconds between chats per user")
+    parser.add_argument("--heartbeat-interval", type=float, default=10)
+    parser.add_argument("--file-users", type=int, default=2, help="users that upload and download a file")
+    parser.add_argument("--file-size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--codec", default="json", choices=codecs.available())
+    parser.add_argument("--batch", action="store_true", help="accept batch frames from the server")
+    parser.add_argument("--no-compression", action="store_true", help="don't negotiate permessage-deflate")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--idle", action="store_true",
+                        help="connect and stay quiet (no chat, heartbeats or files), for memory per connection")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for in-flight messages")
+    parser.add_argument("--server-pid", type=int, help="pid of a running server to sample CPU/RSS from")
+    parser.add_argument("--spawn-server", action="store_true", help="start server.py with bench accounts")
+    parser.add_argument("--server-workers", type=int, default=1)
+    parser.add_argument("--dense", action="store_true", help="start the server with its --dense profile")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="previous results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change before flagging")
+    args = parser.parse_args()
+
+    config = {
+        "url": args.url,
+        "users": args.users,
+        "processes": args.processes,
+        "duration": args.duration,
+        "chat_interval": args.chat_interval,
+        "heartbeat_interval": args.heartbeat_interval,
+        "file_users": min(args.file_users, args.users),
+        "file_size": args.file_size,
+        "codec": args.codec,
+        "batch": args.batch,
+        "compression": not args.no_compression,
+        "idle": args.idle,
+        "connect_concurrency": args.connect_concurrency,
+        "drain": args.drain,
+        "server_workers": args.server_workers,
+        "dense": args.dense
+    }
+
+    server = None
+    server_pid = args.server_pid
+    if args.spawn_server:
+        server = subprocess.Popen([
+            sys.executable, "server.py",
+            "--workers", str(args.server_workers),
+            "--bench-users", str(args.users)
+        ] + (["--dense"] if args.dense else []))
+        server_pid = server.pid
+        if not wait_for_port("localhost", 8765):
+            print("Server did not start.")
+            server.terminate()
+            return 1
+
+    try:
+        report = asyncio.run(run(config, server_pid))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({k: v for k, v in report.items() if k != "config"}, indent=2))
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(report, json.load(f), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import asyncio
+import collections
+import time
+import websockets
+from codec import JSON
+
+# Overflow policies for a full client queue
+DROP_OLDEST = "drop_oldest"   # discard the oldest queued frame
+DISCONNECT = "disconnect"     # close the slow consumer
+COALESCE = "coalesce"         # replace a queued frame with the same key, else drop oldest
+
+POLICIES = (DROP_OLDEST, DISCONNECT, COALESCE)
+
+# Batching (for clients that opt in): during a burst the writer lingers BATCH_WINDOW
+# seconds and sends what has queued up as one "batch" frame
+BATCH_WINDOW = 0.005
+BATCH_MESSAGES = 100
+BATCH_BYTES = 64 * 1024
+
+
+class ClientQueue:
+    """Bounded outbound queue for one connection, drained by its own writer task
+
+    The writer only exists while there is something to send, so an idle
+    connection costs a deque and a few fields rather than a parked task.
+    """
+
+    __slots__ = (
+        "websocket", "codec", "send_latency", "max_size", "policy", "batch_window", "batch_messages",
+        "batch_bytes", "frames", "task", "closed", "last_write", "sent", "writes", "dropped", "peak"
+    )
+
+    def __init__(self, websocket, max_size=256, policy=DROP_OLDEST, codec=JSON, send_latency=None,
+                 batch_window=None, batch_messages=BATCH_MESSAGES, batch_bytes=BATCH_BYTES):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.websocket = websocket
+        self.codec = codec
+        self.send_latency = send_latency  # optional histogram of queue + send time
+        self.max_size = max_size
+        self.policy = policy
+        # None sends every message in its own frame; 0 batches only what queued during the last send
+        self.batch_window = batch_window
+        self.batch_messages = batch_messages if batch_window is not None else 1
+        self.batch_bytes = batch_bytes
+        self.frames = collections.deque()  # (key, data, queued at)
+        self.task = None  # writer, running only while frames are waiting
+        self.closed = False
+        self.last_write = 0.0  # loop time of the last send
+        self.sent = 0  # messages
+        self.writes = 0  # websocket frames, fewer than sent when batching
+        self.dropped = 0
+        self.peak = 0
+
+    def depth(self):
+        """Number of frames waiting to be written"""
+        return len(self.frames)
+
+    def put(self, data, key=None):
+        """Queue an already serialized frame without waiting"""
+        if self.closed:
+            return False
+
+        if key is not None and self.policy == COALESCE:
+            # Newer frame with the same key supersedes the queued one
+            for i, (queued_key, _, queued_at) in enumerate(self.frames):
+                if queued_key == key:
+                    self.frames[i] = (key, data, queued_at)
+                    self.dropped += 1
+                    return True
+
+        if len(self.frames) >= self.max_size:
+            if self.policy == DISCONNECT:
+                self._disconnect()
+                return False
+            self.frames.popleft()
+            self.dropped += 1
+
+        self.frames.append((key, data, time.perf_counter()))
+        self.peak = max(self.peak, len(self.frames))
+        if self.task is None:
+            self.task = asyncio.create_task(self._writer())
+        return True
+
+    def _disconnect(self):
+        """Drop everything and close a consumer that can't keep up"""
+        self.closed = True
+        self.dropped += len(self.frames)
+        self.frames.clear()
+        if self.task:
+            self.task.cancel()
+        asyncio.create_task(self.websocket.close(code=1008, reason="Client too slow"))
+
+    def _take(self):
+        """Pop the next frame, or as many as fit in one batch"""
+        batch = [self.frames.popleft()]
+        size = len(batch[0][1])
+        while self.frames and len(batch) < self.batch_messages:
+            size += len(self.frames[0][1])
+            if size > self.batch_bytes:
+                break
+            batch.append(self.frames.popleft())
+        return batch
+
+    async def _writer(self):
+        """Send queued frames so only this client waits on its socket; returns once they're all sent"""
+        loop = asyncio.get_running_loop()
+        try:
+            while self.frames:
+                # Quiet traffic goes straight out; mid-burst, wait for the rest of the burst
+                if (self.batch_window and len(self.frames) < self.batch_messages
+                        and loop.time() - self.last_write < self.batch_window):
+                    await asyncio.sleep(self.batch_window)
+
+                batch = self._take()
+                if len(batch) == 1:
+                    data = batch[0][1]
+                else:
+                    data = self.codec.encode_batch([frame for _, frame, _ in batch])
+                await self.websocket.send(data)
+                self.last_write = loop.time()
+                self.sent += len(batch)
+                self.writes += 1
+                if self.send_latency:
+                    now = time.perf_counter()
+                    for _, _, queued_at in batch:
+                        self.send_latency.observe(now - queued_at)
+        except websockets.exceptions.ConnectionClosed:
+            self.closed = True
+            self.frames.clear()
+        finally:
+            self.task = None
+
+    async def close(self):
+        """Stop the writer task"""
+        self.closed = True
+        self.frames.clear()
+        task = self.task
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        return {
+            "depth": len(self.frames),
+            "peak": self.peak,
+            "sent": self.sent,
+            "frames": self.writes,
+            "dropped": self.dropped
+        }
+
+
+class Broadcaster:
+    """Creates per-client queues, and serializes each message once to fan it out to them"""
+
+    def __init__(self, max_queue=256, policy=DROP_OLDEST, send_latency=None, batch_window=BATCH_WINDOW, shared=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.max_queue = max_queue
+        self.policy = policy
+        self.send_latency = send_latency
+        self.batch_window = batch_window  # used for clients that accept batches; None disables
+        self.shared = shared  # called with each frame queued for several clients, e.g. CompressionPolicy.share
+
+    def add(self, websocket, codec=JSON, batch=False):
+        """Queue for a newly authenticated connection; the caller keeps it"""
+        return ClientQueue(
+            websocket, self.max_queue, self.policy, codec, self.send_latency,
+            self.batch_window if batch else None
+        )
+
+    async def remove(self, client):
+        """Stop the writer for a closed connection"""
+        await client.close()
+
+    def send(self, client, message, key=None):
+        """Queue a message for a single connection"""
+        return client.put(client.codec.encode(message), key)
+
+    def publish(self, message, clients, key=None):
+        """Queue a message for many connections, encoding it once per codec"""
+        encoded = {}  # codec -> frame
+        delivered = 0
+        for client in clients:
+            data = encoded.get(client.codec)
+            if data is None:
+                data = encoded[client.codec] = client.codec.encode(message)
+            if client.put(data, key):
+                delivered += 1
+        # Writers haven't run yet, so the frames are marked before any is compressed
+        if self.shared and delivered > 1:
+            for data in encoded.values():
+                self.shared(data)
+        return delivered
@@ -0,0 +1,318 @@
+import asyncio
+import json
+from replay import ReplayLog
+
+# Largest single bus message (a JSON line)
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+def _join(rooms, joined, username, room):
+    rooms.setdefault(room, {})[username] = None
+    joined.setdefault(username, set()).add(room)
+
+
+def _leave(rooms, joined, username, room):
+    members = rooms.get(room)
+    if members is not None:
+        members.pop(username, None)
+        if not members:
+            del rooms[room]
+    user_rooms = joined.get(username)
+    if user_rooms is not None:
+        user_rooms.discard(room)
+        if not user_rooms:
+            del joined[username]
+
+
+class LocalBus:
+    """In-process bus: presence and fan-out for a single server process"""
+
+    def __init__(self):
+        self.online = {}  # username -> None, kept in login order
+        self.rooms = {}  # room -> {username: None}, kept in join order
+        self.joined = {}  # username -> set of rooms
+        self.log = ReplayLog()  # event sequence numbers and recent events for reconnects
+        self.subscriber = None
+
+    def subscribe(self, callback):
+        """Register callback(message, key, room, user) for every published message"""
+        self.subscriber = callback
+
+    async def start(self):
+        pass
+
+    async def claim(self, username):
+        """Mark a user online; False if they already are anywhere"""
+        if username in self.online:
+            return False
+        self.online[username] = None
+        return True
+
+    async def release(self, username):
+        self.online.pop(username, None)
+        for room in list(self.joined.get(username, ())):
+            self._leave(username, room)
+
+    async def users(self):
+        return list(self.online)
+
+    async def is_online(self, username):
+        return username in self.online
+
+    async def join(self, username, room):
+        _join(self.rooms, self.joined, username, room)
+
+    def _leave(self, username, room):
+        _leave(self.rooms, self.joined, username, room)
+
+    async def leave(self, username, room):
+        self._leave(username, room)
+
+    async def members(self, room):
+        return list(self.rooms.get(room, ()))
+
+    async def room_list(self):
+        """Room name -> member count"""
+        return {room: len(members) for room, members in self.rooms.items()}
+
+    async def publish(self, message, key=None, room=None, user=None):
+        """Deliver a message to every worker (here, just this one), for a room or one user if given"""
+        message = self.log.record(message, room, user)
+        if self.subscriber:
+            self.subscriber(message, key, room, user)
+
+    async def replay(self, username, rooms, after, callback):
+        """Join a reconnecting user to rooms and pass callback(events) what they missed since seq after
+
+        callback runs at the point in the event order where live events for
+        those rooms start reaching the user, so nothing is lost or repeated.
+        Returns the rooms whose recent events no longer go back that far.
+        """
+        for room in rooms:
+            _join(self.rooms, self.joined, username, room)
+        events, missed = self.log.since(username, rooms, after)
+        callback(events)
+        return missed
+
+    async def close(self):
+        pass
+
+
+class SocketBus:
+    """Worker side of the broker bus, over a local TCP connection"""
+
+    def __init__(self, host="127.0.0.1", port=8766):
+        self.host = host
+        self.port = port
+        self.subscriber = None
+        self.pending = {}  # request id -> (future, callback run on the reply before later lines)
+        self.next_id = 0
+        self.reader = None
+        self.writer = None
+        self.task = None
+
+    def subscribe(self, callback):
+        """Register callback(message, key, room, user) for every published message"""
+        self.subscriber = callback
+
+    async def start(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, limit=LINE_LIMIT
+        )
+        self.task = asyncio.create_task(self._read_loop())
+
+    def _write(self, request):
+        self.writer.write(json.dumps(request).encode() + b"\n")
+
+    async def _request(self, op, callback=None, **fields):
+        """Send a request to the broker and wait for its reply"""
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = (future, callback)
+        self._write({"op": op, "id": self.next_id, **fields})
+        await self.writer.drain()
+        return await future
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                data = json.loads(line)
+                if data["op"] == "reply":
+                    future, callback = self.pending.pop(data["id"], (None, None))
+                    if future is None or future.done():
+                        continue
+                    try:
+                        # Before reading on, so the callback sees exactly the events published before the reply
+                        if callback:
+                            callback(data["result"])
+                        future.set_result(data["result"])
+                    except Exception as e:
+                        future.set_exception(e)
+                elif data["op"] == "publish" and self.subscriber:
+                    message = data["message"]
+                    message["event_seq"] = data["seq"]
+                    self.subscriber(message, data.get("key"), data.get("room"), data.get("user"))
+        finally:
+            for future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Bus connection lost"))
+            self.pending.clear()
+
+    async def claim(self, username):
+        """Mark a user online; False if they already are on any worker"""
+        return await self._request("claim", username=username)
+
+    async def release(self, username):
+        self._write({"op": "release", "username": username})
+        await self.writer.drain()
+
+    async def users(self):
+        return await self._request("users")
+
+    async def is_online(self, username):
+        return await self._request("is_online", username=username)
+
+    async def join(self, username, room):
+        self._write({"op": "join", "username": username, "room": room})
+        await self.writer.drain()
+
+    async def leave(self, username, room):
+        self._write({"op": "leave", "username": username, "room": room})
+        await self.writer.drain()
+
+    async def members(self, room):
+        return await self._request("members", room=room)
+
+    async def room_list(self):
+        """Room name -> member count, across all workers"""
+        return await self._request("room_list")
+
+    async def publish(self, message, key=None, room=None, user=None):
+        """Deliver a message to the workers with members in room, the worker owning user, or all"""
+        self._write({"op": "publish", "message": message, "key": key, "room": room, "user": user})
+        await self.writer.drain()
+
+    async def replay(self, username, rooms, after, callback):
+        """Join a reconnecting user to rooms and pass callback(events) what they missed since seq after
+
+        The broker joins and collects the events in one step, and callback runs
+        as its reply is read, before any event published after it.
+        Returns the rooms whose recent events no longer go back that far.
+        """
+        result = await self._request(
+            "replay", lambda result: callback(result["events"]), username=username, rooms=rooms, after=after
+        )
+        return result["missed"]
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+class Broker:
+    """Holds global presence and room membership, and relays published messages to workers"""
+
+    def __init__(self):
+        self.workers = set()  # stream writers
+        self.online = {}  # username -> writer of the worker that owns them
+        self.rooms = {}  # room -> {username: None}
+        self.joined = {}  # username -> set of rooms
+        self.log = ReplayLog()  # one sequence for every worker's events
+
+    async def handle(self, reader, writer):
+        self.workers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                op = request["op"]
+
+                if op == "publish":
+                    # Number the event, then relay the encoded line with the number spliced in,
+                    # only to workers that have a recipient
+                    room, user = request.get("room"), request.get("user")
+                    seq = self.log.record(request["message"], room, user)["event_seq"]
+                    line = b'{"seq": %d, ' % seq + line[1:]
+                    for worker in self._targets(room, user):
+                        worker.write(line)
+
+                elif op == "claim":
+                    username = request["username"]
+                    ok = username not in self.online
+                    if ok:
+                        self.online[username] = writer
+                    self._reply(writer, request, ok)
+
+                elif op == "release":
+                    if self.online.get(request["username"]) is writer:
+                        self._release(request["username"])
+
+                elif op == "users":
+                    self._reply(writer, request, list(self.online))
+
+                elif op == "is_online":
+                    self._reply(writer, request, request["username"] in self.online)
+
+                elif op == "join":
+                    _join(self.rooms, self.joined, request["username"], request["room"])
+
+                elif op == "leave":
+                    _leave(self.rooms, self.joined, request["username"], request["room"])
+
+                elif op == "members":
+                    self._reply(writer, request, list(self.rooms.get(request["room"], ())))
+
+                elif op == "room_list":
+                    self._reply(writer, request, {
+                        room: len(members) for room, members in self.rooms.items()
+                    })
+
+                elif op == "replay":
+                    # Join and collect in one step: later publishes reach the worker after this reply
+                    username = request["username"]
+                    for room in request["rooms"]:
+                        _join(self.rooms, self.joined, username, room)
+                    events, missed = self.log.since(username, request["rooms"], request["after"])
+                    self._reply(writer, request, {"events": events, "missed": missed})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # A worker went away: free every user it owned
+            self.workers.discard(writer)
+            for username in [u for u, w in self.online.items() if w is writer]:
+                self._release(username)
+            writer.close()
+
+    def _targets(self, room, user):
+        if user is not None:
+            worker = self.online.get(user)
+            return (worker,) if worker else ()
+        if room is not None:
+            online = self.online
+            return {online[u] for u in self.rooms.get(room, ()) if u in online}
+        return self.workers
+
+    def _release(self, username):
+        del self.online[username]
+        for room in list(self.joined.get(username, ())):
+            _leave(self.rooms, self.joined, username, room)
+
+    def _reply(self, writer, request, result):
+        writer.write(json.dumps({"op": "reply", "id": request["id"], "result": result}).encode() + b"\n")
+
+
+async def run_broker(host="127.0.0.1", port=8766, ready=None):
+    """Serve the broker until cancelled"""
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle, host, port, limit=LINE_LIMIT)
+    if ready:
+        ready.set()
+    async with server:
+        await server.serve_forever()
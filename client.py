@@ -1,227 +1,681 @@
+import argparse
 import asyncio
-import json
 import ssl
 import websockets
 import os
 import base64
+import random
 import signal
+import time
+import json
+import sys
+import codec as codecs
+import compression
+import tui
+from rooms import DEFAULT_ROOM
+from storage import BackgroundWriter, FileStore
+from transfer import MAX_FILE_SIZE, hash_file, is_chunk, iter_chunks, new_transfer_id, pack_chunk, unpack_chunk
 
 SERVER_URL = "wss://localhost:8765"
-HEARTBEAT_INTERVAL = 10  # seconds
+# The client's protocol pings are the only keepalive: they keep the connection
+# under the server's idle timeout and detect a dead server (no pong in time)
+HEARTBEAT_INTERVAL = 20  # seconds
+HEARTBEAT_TIMEOUT = 20
+RECONNECT_DELAY = 0.5  # cap on the first retry's random delay, doubled per attempt
+RECONNECT_MAX_DELAY = 30
+RECONNECT_STABLE = 30  # seconds a connection has to stay up before backoff starts over
+COMPRESSION = compression.CompressionPolicy()  # permessage-deflate settings, see compression.py
+SESSION_PATH = ".chat_session"  # last session token, so restarting the client skips the password
 
-# Create downloads directory
-os.makedirs("downloads", exist_ok=True)
+def load_session():
+    """Saved {"server", "username", "token"} for SERVER_URL, or None"""
+    try:
+        with open(SESSION_PATH) as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return session if session.get("server") == SERVER_URL else None
 
-async def main():
-    # Setup
-    shutdown_event = asyncio.Event()
-    
-    # Handle Ctrl+C
-    def signal_handler():
-        print("\nExiting chat...")
-        shutdown_event.set()
-    
+def save_session(username, token):
+    fd = os.open(SESSION_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"server": SERVER_URL, "username": username, "token": token}, f)
+
+def clear_session():
     try:
-        loop = asyncio.get_running_loop()
-        for sig in (signal.SIGINT, signal.SIGTERM):
-            loop.add_signal_handler(sig, signal_handler)
-    except:
+        os.remove(SESSION_PATH)
+    except FileNotFoundError:
         pass
+
+async def open_session(ssl_context, credentials):
+    """Connect and authenticate with a password or token; returns (websocket, welcome)
     
-    # Clear screen and show welcome message
-    os.system('cls' if os.name == 'nt' else 'clear')
-    print("=== Team Chat Client ===")
-    print("Commands: /help, /exit, /users, /file <path>, /download <file_id>, /clear")
-    
-    # Get credentials
-    username = input("Username: ")
-    password = input("Password: ")
+    On failure websocket is None and the second item is the server's reply.
+    """
+    websocket = await websockets.connect(
+        SERVER_URL,
+        ssl=ssl_context,
+        ping_interval=HEARTBEAT_INTERVAL,
+        ping_timeout=HEARTBEAT_TIMEOUT,
+        compression=None,
+        extensions=COMPRESSION.client_extensions()
+    )
+    # Authenticate, offering the codecs we support
+    await websocket.send(codecs.JSON.encode({
+        "type": "auth",
+        **credentials,
+        "codecs": codecs.available(),
+        "batch": True
+    }))
     
-    # Set up SSL
-    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    response = codecs.decode(await websocket.recv())
+    if response.get("type") != "welcome":
+        await websocket.close()
+        return None, response
+    return websocket, response
+
+# Downloads directory; file writes run off the event loop
+downloads = FileStore("downloads", workers=1)
+
+def make_ssl_context():
+    """TLS context for SERVER_URL, or None if server.crt is missing"""
     if not os.path.exists("server.crt"):
-        print("Server certificate not found. Generate with:")
-        print("openssl req -x509 -newkey rsa:4096 -keyout server.key -out server.crt -days 365 -nodes")
-        return
-    
+        return None
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
     ssl_context.load_verify_locations("server.crt")
     ssl_context.check_hostname = False
     ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+async def run_client(ui, ssl_context, shutdown_event, credentials=None, remember=True):
+    """One chat session, shown on and driven from ui (see tui.py)
     
+    Without credentials the saved session is resumed or a password asked for.
+    With remember the new token is saved; scripted sessions pass their own
+    credentials (a password or the saved token) with remember off, so they
+    never prompt or touch the saved session.
+    """
     try:
-        # Connect to server
-        async with websockets.connect(
-            SERVER_URL,
-            ssl=ssl_context,
-            ping_interval=None
-        ) as websocket:
-            # Authenticate
-            await websocket.send(json.dumps({
-                "type": "auth", 
-                "username": username, 
-                "password": password
-            }))
-            
-            response = await websocket.recv()
-            auth_response = json.loads(response)
-            
-            if auth_response.get("type") == "system" and "Authentication failed" in auth_response.get("message", ""):
-                print("Authentication failed.")
+        # Resume the saved session if there is one, otherwise log in with a password
+        websocket = None
+        if credentials is None:
+            session = load_session()
+            if session:
+                websocket, welcome = await open_session(ssl_context, {"token": session["token"]})
+                if websocket is None:
+                    print("Saved session expired, please log in again.")
+                    clear_session()
+            if websocket is None:
+                credentials = {"username": input("Username: "), "password": input("Password: ")}
+        
+        if websocket is None:
+            websocket, welcome = await open_session(ssl_context, credentials)
+            if websocket is None:
+                ui.write(welcome.get("message", "Authentication failed."))
+                if "token" in credentials:
+                    ui.write("The saved session can't be used; run with --user NAME:PASSWORD.")
                 return
+        
+        # Keep the fresh token for next time
+        username = welcome["username"]
+        token = welcome["token"]
+        if remember:
+            save_session(username, token)
+        codec = codecs.CODECS.get(welcome.get("codec"), codecs.JSON)
+        
+        async def send(message):
+            try:
+                await websocket.send(codec.encode(message))
+            except websockets.exceptions.ConnectionClosed:
+                ui.write("Not connected, message not sent.")
+        
+        await ui.start()
+        ui.write(f"Connected as {username}! Type /help for commands.")
+        
+        current_room = DEFAULT_ROOM  # where chat and files go
+        joined_rooms = set()
+        room_users = {}  # room -> users online there, kept current from users_diff
+        oldest_seq = {}  # room -> oldest history message seen, for /history
+        last_event = None  # newest event_seq seen; the server replays anything after it on reconnect
+        pending_uploads = {}  # upload_id -> local path
+        pending_downloads = {}  # download_id -> (file_id, partial file name)
+        active_downloads = {}  # download_id -> [BackgroundWriter, filename, size, partial file name, file_id]
+        link = "connected"
+        reconnects = 0  # attempts since the last connection that stayed up RECONNECT_STABLE
+        connected_at = time.monotonic()
+        
+        def show_status():
+            ui.status(f" {username} | #{current_room or '-'} | {link}")
+        
+        show_status()
+        
+        # Stream a file to the server in binary chunks
+        async def send_file_chunks(upload_id, file_path, offset):
+            # Don't spend CPU deflating zip/png/jpg data
+            if compression.incompressible(file_path):
+                compression.send_raw(websocket, upload_id)
+            try:
+                for chunk_offset, chunk in iter_chunks(file_path, offset):
+                    await websocket.send(pack_chunk(upload_id, chunk_offset, chunk))
+            finally:
+                compression.forget(websocket, upload_id)
+        
+        # Downloads are written by background tasks so a slow disk doesn't hold up the receive loop
+        async def finish_download(writer, filename, size, part_name, file_id):
+            filename = os.path.basename(filename)
+            try:
+                await writer.close()
+                await downloads.replace(part_name, filename)
+            except OSError as e:
+                ui.write(f"Download of {filename} failed: {e}")
+                return
+            ui.write(f"Downloaded: {downloads.path(filename)} ({size} bytes)")
+        
+        async def save_file_data(filename, file_data):
+            await downloads.save(filename, file_data)
+            ui.write(f"Downloaded: {downloads.path(filename)}")
+        
+        # Define message handler
+        def room_prefix(data):
+            room = data.get("room")
+            return f"[#{room}] " if room and room != current_room else ""
+        
+        async def start_upload(upload_id, file_path):
+            # Declare size and hash up front; the server checks both before taking any data
+            await send({
+                "type": "upload_start",
+                "room": current_room,
+                "upload_id": upload_id,
+                "filename": os.path.basename(file_path),
+                "size": os.path.getsize(file_path),
+                "sha256": await downloads.run(hash_file, file_path)
+            })
+        
+        async def request_download(file_id):
+            # Resume into an existing partial download if there is one
+            download_id = new_transfer_id()
+            part_name = os.path.basename(file_id) + ".part"
+            st = await downloads.stat(part_name)
+            offset = st.st_size if st else 0
+            pending_downloads[download_id] = (file_id, part_name)
             
-            print("Connected! Start chatting...")
+            await send({
+                "type": "download_request",
+                "file_id": file_id,
+                "download_id": download_id,
+                "offset": offset
+            })
+        
+        async def handle_message(data):
+            nonlocal current_room, last_event
+            msg_type = data.get("type", "")
             
-            # Define message handler
-            async def handle_messages():
-                async for message in websocket:
-                    if shutdown_event.is_set():
-                        break
-                    
-                    data = json.loads(message)
-                    msg_type = data.get("type", "")
-                    
-                    if msg_type == "chat":
-                        print(f"\n[{data['from']}] {data['message']}")
-                    
-                    elif msg_type == "system":
-                        print(f"\n[SYSTEM] {data['message']}")
-                    
-                    elif msg_type == "users_list":
-                        users = data.get("users", [])
-                        print(f"\nOnline users: {', '.join(users)}")
+            # Events fanned out by the server are numbered; skip any already shown
+            seq = data.get("event_seq")
+            if seq is not None:
+                if last_event is not None and seq <= last_event:
+                    return
+                last_event = seq
+            
+            if msg_type == "chat":
+                ui.write(f"{room_prefix(data)}[{data['from']}] {data['message']}")
+            
+            elif msg_type == "direct":
+                if data.get("from") == username:
+                    ui.write(f"[DM to {data.get('to')}] {data.get('message')}")
+                else:
+                    ui.write(f"[DM from {data.get('from')}] {data.get('message')}")
+            
+            elif msg_type == "system":
+                ui.write(f"{room_prefix(data)}[SYSTEM] {data['message']}")
+            
+            elif msg_type == "joined":
+                current_room = data.get("room")
+                joined_rooms.add(current_room)
+                show_status()
+                ui.write(f"Now chatting in #{current_room}")
+            
+            elif msg_type == "left":
+                room = data.get("room")
+                joined_rooms.discard(room)
+                room_users.pop(room, None)
+                oldest_seq.pop(room, None)
+                ui.write(f"Left #{room}")
+                if room == current_room:
+                    current_room = DEFAULT_ROOM if DEFAULT_ROOM in joined_rooms else next(iter(joined_rooms), None)
+                    show_status()
+                    if current_room:
+                        ui.write(f"Now chatting in #{current_room}")
+            
+            elif msg_type == "rooms":
+                ui.write("Rooms:")
+                for room, count in sorted(data.get("rooms", {}).items()):
+                    marker = "*" if room in data.get("joined", []) else " "
+                    ui.write(f" {marker} #{room} ({count} online)")
+            
+            elif msg_type == "users_list":
+                room = data.get("room", DEFAULT_ROOM)
+                users = data.get("users", [])
+                room_users[room] = dict.fromkeys(users)
+                ui.write(f"Online in #{room}: {', '.join(users)}")
+            
+            elif msg_type == "users_diff":
+                # Joins and leaves in a room, collected over a short window
+                room = data.get("room", DEFAULT_ROOM)
+                users = room_users.setdefault(room, {})
+                joined = [u for u in data.get("joined", []) if u != username]
+                left = data.get("left", [])
+                for user in joined:
+                    users[user] = None
+                for user in left:
+                    users.pop(user, None)
+                prefix = room_prefix(data)
+                if joined:
+                    ui.write(f"{prefix}[SYSTEM] {', '.join(joined)} joined #{room}.")
+                if left:
+                    ui.write(f"{prefix}[SYSTEM] {', '.join(left)} left #{room}.")
+            
+            elif msg_type == "file_shared":
+                sender = data.get("from", "Unknown")
+                filename = data.get("filename", "Unknown")
+                file_id = data.get("file_id", "")
+                ui.write(f"{room_prefix(data)}[FILE] {sender} shared: {filename}")
+                ui.write(f"       To download: /download {file_id}")
+            
+            elif msg_type == "file_data":
+                filename = data.get("filename", "file")
+                file_data = base64.b64decode(data.get("data", ""))
+                
+                asyncio.create_task(save_file_data(os.path.basename(filename), file_data))
+            
+            elif msg_type == "history":
+                room = data.get("room", DEFAULT_ROOM)
+                messages = data.get("messages", [])
+                oldest_seq[room] = messages[0]["seq"] if messages and data.get("more") else None
+                if messages:
+                    ui.write(f"--- Earlier messages in #{room} ---")
+                    for item in messages:
+                        stamp = time.strftime("%H:%M", time.localtime(item.get("timestamp", 0)))
+                        if item.get("type") == "file_shared":
+                            ui.write(f"{stamp} [FILE] {item.get('from')} shared: {item.get('filename')} ({item.get('file_id')})")
+                        else:
+                            ui.write(f"{stamp} [{item.get('from')}] {item.get('message')}")
+                    if data.get("more"):
+                        ui.write("--- /history for older messages ---")
+            
+            elif msg_type == "upload_ready":
+                upload_id = data.get("upload_id")
+                file_path = pending_uploads.get(upload_id)
+                if file_path:
+                    asyncio.create_task(
+                        send_file_chunks(upload_id, file_path, data.get("offset", 0))
+                    )
+            
+            elif msg_type == "upload_progress":
+                upload_id = data.get("upload_id")
+                received = data.get("received", 0)
+                size = data.get("size", 0)
+                percent = 100 if not size else received * 100 // size
+                ui.write(f"Upload {percent}% ({received}/{size} bytes)")
+                if received == size:
+                    pending_uploads.pop(upload_id, None)
+            
+            elif msg_type == "upload_error":
+                pending_uploads.pop(data.get("upload_id"), None)
+                ui.write(f"[UPLOAD] {data.get('message', 'Upload failed')}")
+            
+            elif msg_type == "resumed":
+                caught_up = f", caught up on {data.get('replayed', 0)} messages" if data.get("replayed") else ""
+                ui.write(f"Reconnected{caught_up}.")
+                for room in data.get("missed", []):
+                    ui.write(f"Some messages in #{room} were missed; showing recent history instead.")
+            
+            elif msg_type == "download_start":
+                download_id = data.get("download_id")
+                file_id, part_name = pending_downloads.pop(download_id, (None, None))
+                if part_name:
+                    # Append from the offset the server agreed to resume at
+                    exists = await downloads.stat(part_name) is not None
+                    f = await downloads.open(part_name, "r+b" if exists else "wb")
+                    await f.seek(data.get("offset", 0))
+                    await f.truncate()
+                    active_downloads[download_id] = [
+                        BackgroundWriter(f), data.get("filename", "file"), data.get("size", 0), part_name, file_id
+                    ]
+            
+            elif msg_type == "download_complete":
+                download = active_downloads.pop(data.get("download_id"), None)
+                if download:
+                    asyncio.create_task(finish_download(*download))
+        
+        async def handle_messages():
+            async for message in websocket:
+                if shutdown_event.is_set():
+                    break
+                
+                # Chunk frames carry download data
+                if is_chunk(message):
+                    download_id, offset, chunk = unpack_chunk(message)
+                    download = active_downloads.get(download_id)
+                    if download:
+                        await download[0].put(chunk)
+                    continue
+                
+                data = codecs.decode(message)
+                
+                # A batch frame carries several messages sent close together
+                for item in data.get("messages", []) if data.get("type") == "batch" else [data]:
+                    await handle_message(item)
+
+        
+        async def reconnect():
+            """Log back in with the session token, backing off with jitter; False if that's not possible
+            
+            Each wait is random up to a cap that doubles per attempt, so clients
+            cut off together (a server restart) don't all come back at once. The
+            count only starts over once a connection has lasted RECONNECT_STABLE.
+            """
+            nonlocal websocket, codec, token, reconnects, connected_at
+            # A connection that drops right after opening keeps backing off rather than starting over
+            if time.monotonic() - connected_at >= RECONNECT_STABLE:
+                reconnects = 0
+            while True:
+                delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** min(reconnects, 16)))
+                reconnects += 1
+                ui.write(f"Reconnecting in {delay:.1f}s...")
+                try:
+                    await asyncio.wait_for(shutdown_event.wait(), delay)
+                    return False
+                except asyncio.TimeoutError:
+                    pass
+                
+                try:
+                    new_websocket, reply = await open_session(ssl_context, {
+                        "token": token,
+                        "resume": {"after": last_event, "rooms": sorted(joined_rooms)}
+                    })
+                except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException):
+                    continue
+                
+                if new_websocket is None:
+                    # The server may not have noticed the old connection drop yet
+                    if "already logged in" in reply.get("message", ""):
+                        continue
+                    ui.write(f"{reply.get('message', 'Authentication failed.')} Restart the client to log in again.")
+                    if remember:
+                        clear_session()
+                    return False
+                
+                websocket = new_websocket
+                connected_at = time.monotonic()
+                token = reply["token"]
+                if remember:
+                    save_session(username, token)
+                codec = codecs.CODECS.get(reply.get("codec"), codecs.JSON)
+                return True
+        
+        async def resume_transfers():
+            # Uploads continue from what the server has; downloads from the partial file
+            for upload_id, file_path in pending_uploads.items():
+                await start_upload(upload_id, file_path)
+            for download_id in list(active_downloads):
+                writer, _, _, _, file_id = active_downloads.pop(download_id)
+                try:
+                    await writer.close()
+                except OSError:
+                    pass  # the partial file's size says where to resume from
+                await request_download(file_id)
+        
+        # Define input handler
+        async def handle_input():
+            nonlocal current_room
+            
+            while not shutdown_event.is_set():
+                message = await ui.read_line()
+                
+                if message.startswith("/"):
+                    cmd = message.split(" ", 1)
+                    command = cmd[0].lower()
                     
-                    elif msg_type == "file_shared":
-                        sender = data.get("from", "Unknown")
-                        filename = data.get("filename", "Unknown")
-                        file_id = data.get("file_id", "")
-                        print(f"\n[FILE] {sender} shared: {filename}")
-                        print(f"       To download: /download {file_id}")
+                    if command == "/exit":
+                        shutdown_event.set()
+                        break
                     
-                    elif msg_type == "file_data":
-                        filename = data.get("filename", "file")
-                        file_data = base64.b64decode(data.get("data", ""))
+                    elif command == "/logout":
+                        # Forget the saved session so the next start asks for a password
+                        if remember:
+                            clear_session()
+                        shutdown_event.set()
+                        break
                         
-                        file_path = os.path.join("downloads", filename)
-                        with open(file_path, "wb") as f:
-                            f.write(file_data)
+                    elif command == "/help":
+                        ui.write("Commands:")
+                        ui.write("  /help - Show this help")
+                        ui.write("  /exit - Exit the chat")
+                        ui.write("  /logout - Exit and forget the saved session")
+                        ui.write("  /join <room> - Join or switch to a room")
+                        ui.write("  /leave [room] - Leave a room (default: the current one)")
+                        ui.write("  /rooms - List rooms")
+                        ui.write("  /msg <user> <text> - Send a private message")
+                        ui.write("  /users - Show users in the current room")
+                        ui.write("  /file <path> - Send a file")
+                        ui.write("  /download <file_id> - Download a file")
+                        ui.write("  /history - Show older messages")
+                        ui.write("  /clear - Clear the screen")
+                        continue
                         
-                        print(f"\nDownloaded: {file_path}")
-                    
-                    print("> ", end="", flush=True)
-            
-            # Define heartbeat sender
-            async def send_heartbeats():
-                while not shutdown_event.is_set():
-                    try:
-                        await asyncio.sleep(HEARTBEAT_INTERVAL)
-                        await websocket.send(json.dumps({"type": "heartbeat"}))
-                    except:
-                        break
-            
-            # Define input handler
-            async def handle_input():
-                active_users = []
-                
-                while not shutdown_event.is_set():
-                    message = await loop.run_in_executor(None, input, "\n> ")
-                    
-                    if message.startswith("/"):
-                        cmd = message.split(" ", 1)
-                        command = cmd[0].lower()
+                    elif command == "/join":
+                        if len(cmd) < 2:
+                            ui.write("Usage: /join <room>")
+                            continue
                         
-                        if command == "/exit":
-                            shutdown_event.set()
-                            break
-                            
-                        elif command == "/help":
-                            print("\nCommands:")
-                            print("  /help - Show this help")
-                            print("  /exit - Exit the chat")
-                            print("  /users - Show active users")
-                            print("  /file <path> - Send a file")
-                            print("  /download <file_id> - Download a file")
-                            print("  /clear - Clear the screen")
+                        room = cmd[1].strip().lstrip("#").lower()
+                        if room in joined_rooms:
+                            current_room = room
+                            show_status()
+                            ui.write(f"Now chatting in #{room}")
                             continue
-                            
-                        elif command == "/users":
-                            print("\nActive users:")
-                            for user in active_users:
-                                print(f"  {user}")
+                        
+                        await send({"type": "join", "room": room})
+                        continue
+                        
+                    elif command == "/leave":
+                        room = cmd[1].strip().lstrip("#").lower() if len(cmd) > 1 else current_room
+                        if not room:
+                            ui.write("Usage: /leave <room>")
                             continue
-                            
-                        elif command == "/file":
-                            if len(cmd) < 2:
-                                print("Usage: /file <path>")
-                                continue
-                                
-                            file_path = cmd[1].strip()
-                            
-                            if not os.path.exists(file_path):
-                                print(f"File not found: {file_path}")
-                                continue
-                                
-                            if os.path.getsize(file_path) > 10 * 1024 * 1024:
-                                print("File too large (max 10MB)")
-                                continue
-                                
-                            with open(file_path, "rb") as f:
-                                file_data = f.read()
-                            
-                            await websocket.send(json.dumps({
-                                "type": "file",
-                                "filename": os.path.basename(file_path),
-                                "data": base64.b64encode(file_data).decode('utf-8')
-                            }))
-                            
-                            print(f"Sending file: {os.path.basename(file_path)}...")
+                        
+                        await send({"type": "leave", "room": room})
+                        continue
+                        
+                    elif command == "/rooms":
+                        await send({"type": "rooms"})
+                        continue
+                        
+                    elif command == "/msg":
+                        parts = cmd[1].split(" ", 1) if len(cmd) > 1 else []
+                        if len(parts) < 2 or not parts[1].strip():
+                            ui.write("Usage: /msg <user> <text>")
+                            continue
+                        
+                        await send({
+                            "type": "direct",
+                            "to": parts[0],
+                            "message": parts[1]
+                        })
+                        continue
+                        
+                    elif command == "/users":
+                        ui.write(f"Online in #{current_room}:")
+                        for user in room_users.get(current_room, {}):
+                            ui.write(f"  {user}")
+                        continue
+                        
+                    elif command == "/file":
+                        if len(cmd) < 2:
+                            ui.write("Usage: /file <path>")
                             continue
                             
-                        elif command == "/download":
-                            if len(cmd) < 2:
-                                print("Usage: /download <file_id>")
-                                continue
-                                
-                            file_id = cmd[1].strip()
-                            await websocket.send(json.dumps({
-                                "type": "file_request",
-                                "file_id": file_id
-                            }))
-                            
-                            print(f"Requesting file: {file_id}...")
+                        file_path = cmd[1].strip()
+                        
+                        if not os.path.isfile(file_path):
+                            ui.write(f"File not found: {file_path}")
                             continue
                             
-                        elif command == "/clear":
-                            os.system('cls' if os.name == 'nt' else 'clear')
+                        file_size = os.path.getsize(file_path)
+                        if file_size > MAX_FILE_SIZE:
+                            ui.write(f"File too large (max {MAX_FILE_SIZE // (1024 * 1024)}MB)")
+                            continue
+                        
+                        upload_id = new_transfer_id()
+                        pending_uploads[upload_id] = file_path
+                        try:
+                            await start_upload(upload_id, file_path)
+                        except OSError as e:
+                            pending_uploads.pop(upload_id, None)
+                            ui.write(f"Can't read {file_path}: {e.strerror}")
+                            continue
+                        
+                        ui.write(f"Sending file: {os.path.basename(file_path)}...")
+                        continue
+                        
+                    elif command == "/download":
+                        if len(cmd) < 2:
+                            ui.write("Usage: /download <file_id>")
                             continue
                             
-                        else:
-                            print(f"Unknown command: {command}")
+                        file_id = cmd[1].strip()
+                        await request_download(file_id)
+                        
+                        ui.write(f"Requesting file: {file_id}...")
+                        continue
+                        
+                    elif command == "/history":
+                        if oldest_seq.get(current_room) is None:
+                            ui.write("No older messages.")
                             continue
-                    
-                    # Regular chat message
-                    await websocket.send(json.dumps({
-                        "type": "chat",
-                        "message": message
-                    }))
-            
-            # Start tasks
-            tasks = [
-                asyncio.create_task(handle_messages()),
-                asyncio.create_task(send_heartbeats()),
-                asyncio.create_task(handle_input())
-            ]
-            
-            # Wait for shutdown
-            await shutdown_event.wait()
-            
-            # Cancel tasks
-            for task in tasks:
-                task.cancel()
+                        
+                        await send({
+                            "type": "history_request",
+                            "room": current_room,
+                            "before": oldest_seq[current_room]
+                        })
+                        continue
+                        
+                    elif command == "/clear":
+                        ui.clear()
+                        continue
+                        
+                    else:
+                        ui.write(f"Unknown command: {command}")
+                        continue
+                
+                # Regular chat message
+                if current_room is None:
+                    ui.write("You are not in a room. Use /join <room>.")
+                    continue
+                
+                await send({
+                    "type": "chat",
+                    "room": current_room,
+                    "message": message
+                })
+        
+        # Start tasks; input carries on across reconnects
+        inputs = asyncio.create_task(handle_input())
+        tasks = [inputs]
+        stop = asyncio.create_task(shutdown_event.wait())
+        
+        # Read from the current connection until shutdown, reconnecting whenever it drops
+        while True:
+            receiver = asyncio.create_task(handle_messages())
+            await asyncio.wait([receiver, stop, inputs], return_when=asyncio.FIRST_COMPLETED)
+            if inputs.done() and not inputs.cancelled() and inputs.exception():
+                # A failed command would otherwise leave the session waiting on input that never comes
+                ui.write(f"Error: {inputs.exception()}")
+                shutdown_event.set()
+            if shutdown_event.is_set() or inputs.done():
+                receiver.cancel()
+                break
             
+            try:
+                receiver.result()
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            ui.write("Connection lost.")
+            link = "reconnecting"
+            show_status()
+            if not await reconnect():
+                break
+            link = "connected"
+            show_status()
+            await resume_transfers()
+        
+        # Cancel tasks
+        for task in [*tasks, stop]:
+            task.cancel()
+        await websocket.close()
+        
     except Exception as e:
-        print(f"Error: {e}")
+        ui.write(f"Error: {e}")
+    finally:
+        ui.write("Disconnected")
+        ui.stop()
+
+async def main(args):
+    ssl_context = make_ssl_context()
+    if ssl_context is None:
+        print("Server certificate not found. Generate with:")
+        print("openssl req -x509 -newkey rsa:4096 -keyout server.key -out server.crt -days 365 -nodes")
+        return
+    
+    if args.script:
+        # Headless: one session per --user, all following the same script
+        if not args.user and not load_session():
+            print("--script needs --user NAME:PASSWORD or a saved session.")
+            return
+        if args.script != "-":
+            with open(args.script) as f:
+                lines = f.read().splitlines()
+        else:
+            lines = sys.stdin.read().splitlines() if len(args.user) > 1 else None  # None streams stdin
+        if args.user:
+            sessions = []
+            for user in args.user:
+                name, _, password = user.partition(":")
+                label = name if len(args.user) > 1 else ""
+                sessions.append((tui.ScriptUI(lines, label), {"username": name, "password": password}))
+        else:
+            # The saved token is used, but never refreshed or replaced by a password prompt
+            sessions = [(tui.ScriptUI(lines), {"token": load_session()["token"]})]
+    else:
+        # Clear screen and show welcome message
+        os.system('cls' if os.name == 'nt' else 'clear')
+        print("=== Team Chat Client ===")
+        ui = tui.TerminalUI() if tui.supported() and not args.plain else tui.LineUI()
+        sessions = [(ui, None)]
+    
+    # Handle Ctrl+C
+    shutdown_events = [asyncio.Event() for _ in sessions]
+    def signal_handler():
+        for event in shutdown_events:
+            event.set()
+    
+    try:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, signal_handler)
+    except:
+        pass
     
-    print("Disconnected")
+    await asyncio.gather(*(
+        run_client(ui, ssl_context, shutdown_event, credentials, remember=not args.script)
+        for (ui, credentials), shutdown_event in zip(sessions, shutdown_events)
+    ))
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Team chat client")
+    parser.add_argument("--script", help="run headless, taking commands from this file (- for stdin) instead of the keyboard")
+    parser.add_argument("--user", action="append", default=[], help="NAME:PASSWORD to log in as with --script; repeat for several sessions in one process")
+    parser.add_argument("--plain", action="store_true", help="print messages as they arrive instead of the split-pane view")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,142 @@
+import base64
+import json
+import os
+import time
+
+# Optional faster encoders
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# First byte of a binary frame carrying an encoded message (chunk frames use 0x01)
+MESSAGE_FRAME = 0x02
+MESSAGE_PREFIX = bytes([MESSAGE_FRAME])
+
+
+def _text_batch(frames):
+    """One batch message from already encoded JSON messages, without re-encoding them"""
+    return '{"type": "batch", "messages": [' + ", ".join(frames) + "]}"
+
+
+class JsonCodec:
+    """Stdlib JSON in text frames; always available and the default"""
+    name = "json"
+
+    def encode(self, message):
+        return json.dumps(message)
+
+    def encode_batch(self, frames):
+        return _text_batch(frames)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """orjson in text frames"""
+    name = "orjson"
+
+    def encode(self, message):
+        return orjson.dumps(message).decode()
+
+    def encode_batch(self, frames):
+        return _text_batch(frames)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    """msgpack in binary frames, tagged with MESSAGE_FRAME"""
+    name = "msgpack"
+
+    def encode(self, message):
+        return MESSAGE_PREFIX + msgpack.packb(message)
+
+    def encode_batch(self, frames):
+        # {"type": "batch", "messages": [...]} with the encoded messages spliced in after their prefix
+        packer = msgpack.Packer()
+        head = (
+            MESSAGE_PREFIX + packer.pack_map_header(2)
+            + packer.pack("type") + packer.pack("batch")
+            + packer.pack("messages") + packer.pack_array_header(len(frames))
+        )
+        return b"".join([head, *(memoryview(frame)[1:] for frame in frames)])
+
+    def decode(self, data):
+        return msgpack.unpackb(memoryview(data)[1:])
+
+
+JSON = JsonCodec()
+
+# Installed codecs, most preferred first
+CODECS = {}
+if msgpack:
+    CODECS["msgpack"] = MsgpackCodec()
+if orjson:
+    CODECS["orjson"] = OrjsonCodec()
+CODECS["json"] = JSON
+
+
+def available():
+    """Codec names this side can use, most preferred first"""
+    return list(CODECS)
+
+
+def negotiate(offered):
+    """Pick the first codec the peer offered that we also have"""
+    if isinstance(offered, list):
+        for name in offered:
+            if name in CODECS:
+                return CODECS[name]
+    return JSON
+
+
+def decode(data):
+    """Decode a message frame; text frames are JSON, binary ones msgpack"""
+    if isinstance(data, str):
+        return CODECS.get("orjson", JSON).decode(data)
+    if data[:1] == MESSAGE_PREFIX and "msgpack" in CODECS:
+        return CODECS["msgpack"].decode(data)
+    raise ValueError("Unrecognised binary frame")
+
+
+def benchmark(rounds=2000):
+    """Compare encode/decode time and frame size for typical messages"""
+    users = [f"user{i}" for i in range(200)]
+    samples = {
+        "chat": {"type": "chat", "from": "joe", "message": "Has anyone looked at the build failure yet?"},
+        "presence": {"type": "users_list", "users": users},
+        "file": {
+            "type": "file_data",
+            "filename": "report.pdf",
+            "data": base64.b64encode(os.urandom(256 * 1024)).decode("utf-8")
+        }
+    }
+
+    print(f"{'message':<10}{'codec':<10}{'bytes':>10}{'encode us':>12}{'decode us':>12}")
+    for kind, message in samples.items():
+        n = rounds if kind != "file" else max(1, rounds // 100)
+        for name, codec in CODECS.items():
+            start = time.perf_counter()
+            for _ in range(n):
+                data = codec.encode(message)
+            encode_us = (time.perf_counter() - start) / n * 1e6
+
+            start = time.perf_counter()
+            for _ in range(n):
+                codec.decode(data)
+            decode_us = (time.perf_counter() - start) / n * 1e6
+
+            size = len(data.encode()) if isinstance(data, str) else len(data)
+            print(f"{kind:<10}{name:<10}{size:>10}{encode_us:>12.1f}{decode_us:>12.1f}")
+
+
+if __name__ == "__main__":
+    benchmark()
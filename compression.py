@@ -0,0 +1,272 @@
+import base64
+import collections
+import json
+import os
+import time
+import zlib
+from websockets.extensions.permessage_deflate import (
+    ClientPerMessageDeflateFactory, PerMessageDeflate, ServerPerMessageDeflateFactory
+)
+from websockets.frames import CONT, CTRL_OPCODES, Frame
+from transfer import HEADER
+
+# permessage-deflate (RFC 7692) settings, the same on both sides by default.
+# "python compression.py" measures CPU cost against bytes saved for typical traffic.
+# Level 1 keeps ~all of level 6's savings on chat, presence and history at about half the CPU.
+LEVEL = 1  # zlib level 1-9
+MEM_LEVEL = 5  # zlib memLevel 1-9; with WINDOW_BITS 12, ~32KB of compressor state per connection
+WINDOW_BITS = 12  # LZ77 window 9-15; 4KB covers our chat and presence frames
+MIN_SIZE = 64  # frames smaller than this (heartbeats, acks) are sent uncompressed
+# Context takeover lets a 100 byte chat line deflate to ~12 bytes by referring to
+# earlier messages; without it the same line only saves ~15%. Turning it off makes
+# every message compress independently, which is what lets a broadcast be compressed
+# once and shared (SHARED_CACHE), but for our traffic that costs more than it saves.
+CONTEXT_TAKEOVER = True
+SHARED_CACHE = 64  # fanned out payloads remembered once compressed (only without context takeover)
+
+# Already compressed formats; chunks of these files are sent as they are
+INCOMPRESSIBLE = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".heic",
+    ".mp3", ".mp4", ".m4a", ".mov", ".mkv", ".webm", ".ogg",
+    ".pdf", ".docx", ".xlsx", ".pptx", ".jar", ".apk"
+}
+
+
+def incompressible(filename):
+    """True for file types that deflate can't shrink"""
+    return os.path.splitext(filename or "")[1].lower() in INCOMPRESSIBLE
+
+
+class CompressionPolicy:
+    """Which frames get compressed, with what settings, plus counters for the metrics"""
+
+    def __init__(self, enabled=True, level=LEVEL, mem_level=MEM_LEVEL, window_bits=WINDOW_BITS,
+                 min_size=MIN_SIZE, context_takeover=CONTEXT_TAKEOVER, shared_cache=SHARED_CACHE):
+        self.enabled = enabled
+        self.level = level
+        self.mem_level = mem_level
+        self.window_bits = window_bits
+        self.min_size = min_size
+        # Without context takeover every message is compressed on its own, so a
+        # broadcast payload compresses to the same bytes for every recipient
+        self.context_takeover = context_takeover
+        self.cache = collections.OrderedDict() if shared_cache and not context_takeover else None
+        self.cache_size = shared_cache
+        self.bytes_in = 0  # payload bytes of compressed frames
+        self.bytes_out = 0  # what they compressed to
+        self.raw_frames = 0  # frames sent uncompressed by policy
+        self.cache_hits = 0
+        self.seconds = 0.0  # time spent compressing
+
+    def share(self, data):
+        """Mark a payload that is about to go to several connections, so it's compressed once for all of them
+
+        Only marked payloads are cached; one-off frames such as download
+        chunks are compressed and sent without being copied into the cache.
+        """
+        if self.cache is None or len(data) < self.min_size:
+            return
+        if isinstance(data, str):
+            data = data.encode()
+        if data in self.cache:
+            self.cache.move_to_end(data)
+            return
+        self.cache[data] = {}  # local window bits -> compressed payload, filled by the first send
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def compress_settings(self):
+        return {"level": self.level, "memLevel": self.mem_level}
+
+    def server_extensions(self):
+        """Extensions for websockets.serve, or None with compression off"""
+        if not self.enabled:
+            return None
+        return [PolicyServerFactory(
+            self,
+            server_no_context_takeover=not self.context_takeover,
+            client_no_context_takeover=not self.context_takeover,  # then neither side keeps zlib state between messages
+            server_max_window_bits=self.window_bits,
+            client_max_window_bits=self.window_bits,
+            compress_settings=self.compress_settings()
+        )]
+
+    def client_extensions(self):
+        """Extensions for websockets.connect, or None with compression off"""
+        if not self.enabled:
+            return None
+        return [PolicyClientFactory(
+            self,
+            server_max_window_bits=self.window_bits,
+            client_max_window_bits=self.window_bits,
+            compress_settings=self.compress_settings()
+        )]
+
+    def stats(self):
+        return {
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "raw_frames": self.raw_frames,
+            "cache_hits": self.cache_hits,
+            "seconds": round(self.seconds, 6)
+        }
+
+
+class PolicyDeflate(PerMessageDeflate):
+    """permessage-deflate that leaves small frames and incompressible transfers uncompressed
+
+    RFC 7692 lets either side send any message without compression (RSV1
+    clear); the peer's decoder only inflates frames that have it set.
+    """
+
+    def __init__(self, extension, policy):
+        super().__init__(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings
+        )
+        self.policy = policy
+        self.raw_transfers = set()  # 16-byte transfer ids whose chunks skip compression
+        self.raw_message = False  # current fragmented message is being sent raw
+
+    def _raw(self, frame):
+        data = frame.data
+        if len(data) < self.policy.min_size:
+            return True
+        # Chunk frames: kind byte, then the transfer id
+        return data[:1] == b"\x01" and bytes(data[1:HEADER.size - 8]) in self.raw_transfers
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        if frame.opcode is not CONT:
+            self.raw_message = self._raw(frame)
+        if self.raw_message:
+            self.policy.raw_frames += 1
+            return frame
+
+        policy = self.policy
+        started = time.perf_counter()
+        shared = None  # compressed copies of a payload Broadcaster.publish marked as fanned out
+        if (policy.cache is not None and self.local_no_context_takeover and frame.fin
+                and frame.opcode is not CONT and isinstance(frame.data, bytes)):
+            shared = policy.cache.get(frame.data)
+        if shared is not None and self.local_max_window_bits in shared:
+            policy.cache_hits += 1
+            encoded = Frame(frame.opcode, shared[self.local_max_window_bits], frame.fin, True, frame.rsv2, frame.rsv3)
+        else:
+            encoded = super().encode(frame)
+            if shared is not None:
+                shared[self.local_max_window_bits] = bytes(encoded.data)
+        policy.seconds += time.perf_counter() - started
+        policy.bytes_in += len(frame.data)
+        policy.bytes_out += len(encoded.data)
+        return encoded
+
+
+class PolicyServerFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, policy, **kwargs):
+        super().__init__(**kwargs)
+        self.policy = policy
+
+    def process_request_params(self, params, accepted_extensions):
+        response, extension = super().process_request_params(params, accepted_extensions)
+        return response, PolicyDeflate(extension, self.policy)
+
+
+class PolicyClientFactory(ClientPerMessageDeflateFactory):
+    def __init__(self, policy, **kwargs):
+        super().__init__(**kwargs)
+        self.policy = policy
+
+    def process_response_params(self, params, accepted_extensions):
+        extension = super().process_response_params(params, accepted_extensions)
+        return PolicyDeflate(extension, self.policy)
+
+
+def _extension(websocket):
+    for extension in websocket.protocol.extensions:
+        if isinstance(extension, PolicyDeflate):
+            return extension
+    return None
+
+
+def send_raw(websocket, transfer_id):
+    """Send this transfer's chunks on websocket uncompressed"""
+    extension = _extension(websocket)
+    if extension:
+        extension.raw_transfers.add(bytes.fromhex(transfer_id))
+
+
+def forget(websocket, transfer_id):
+    extension = _extension(websocket)
+    if extension:
+        extension.raw_transfers.discard(bytes.fromhex(transfer_id))
+
+
+def benchmark(count=200):
+    """CPU per message against bytes saved for a stream of typical traffic, across settings"""
+    users = [f"user{i}" for i in range(200)]
+    log_lines = [
+        f"2024-05-01 12:{i % 60:02d}:{i * 7 % 60:02d} INFO worker-{i % 8} handled request {i} in {i % 97}ms\n"
+        for i in range(20000)
+    ]
+
+    def text_chunk(i):
+        return "".join(log_lines[i * 700:(i + 1) * 700]).encode()[:64 * 1024]
+
+    def history_page(i):
+        return {"type": "history", "room": "general", "more": True, "messages": [
+            {"type": "chat", "room": "general", "from": users[(i + j) % 7], "seq": i * 50 + j,
+             "timestamp": 1700000000.0 + i * 50 + j, "message": f"Deploy step {i * 50 + j} finished"}
+            for j in range(50)
+        ]}
+
+    # traffic -> function building the i-th message of a stream
+    samples = {
+        "heartbeat": lambda i: json.dumps({"type": "heartbeat_ack", "timestamp": 1700000000.0 + i * 10.37}),
+        "chat": lambda i: json.dumps({"type": "chat", "room": "general", "from": users[i % 7],
+                                      "message": f"Has anyone looked at build {i * 31 % 997} yet?"}),
+        "users_diff": lambda i: json.dumps({"type": "users_diff", "room": "general",
+                                            "joined": users[i % 180:i % 180 + 3], "left": []}),
+        "users_list": lambda i: json.dumps({"type": "users_list", "room": "general", "users": users[:150 + i % 50]}),
+        "history": lambda i: json.dumps(history_page(i)),
+        "text_chunk": text_chunk,
+        "file_data": lambda i: json.dumps({"type": "file_data", "filename": "notes.txt",
+                                           "data": base64.b64encode(text_chunk(i)).decode()}),
+        "zip_chunk": lambda i: os.urandom(64 * 1024),  # compressed data looks random
+    }
+    settings = [  # label, level, memLevel, window bits, context takeover
+        ("level 1, window 12", 1, 5, 12, True),
+        ("level 1, window 15", 1, 8, 15, True),
+        ("level 6, window 12", 6, 5, 12, True),
+        ("level 6, window 15", 6, 8, 15, True),
+        ("level 9, window 15", 9, 8, 15, True),
+        ("level 6, no takeover", 6, 5, 12, False),
+    ]
+
+    print(f"{'traffic':<12}{'settings':<22}{'bytes/msg':>10}{'deflated':>10}{'saved':>8}{'us/msg':>9}")
+    for kind, build in samples.items():
+        n = count if kind in ("heartbeat", "chat", "users_diff", "users_list") else max(1, count // 10)
+        payloads = [build(i) for i in range(n)]
+        payloads = [p.encode() if isinstance(p, str) else p for p in payloads]
+        raw = sum(len(p) for p in payloads)
+        for label, level, mem_level, bits, takeover in settings:
+            # With context takeover one compressor lives as long as the connection;
+            # without it a fresh one is set up for every message
+            encoder = zlib.compressobj(level, zlib.DEFLATED, -bits, mem_level)
+            out = 0
+            start = time.perf_counter()
+            for payload in payloads:
+                if not takeover:
+                    encoder = zlib.compressobj(level, zlib.DEFLATED, -bits, mem_level)
+                out += len(encoder.compress(payload) + encoder.flush(zlib.Z_SYNC_FLUSH)) - 4
+            per_message = (time.perf_counter() - start) / n * 1e6
+            print(f"{kind:<12}{label:<22}{raw // n:>10}{out // n:>10}{1 - out / raw:>8.0%}{per_message:>9.1f}")
+
+
+if __name__ == "__main__":
+    benchmark()
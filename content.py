@@ -0,0 +1,304 @@
+import asyncio
+import base64
+import collections
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from transfer import hash_file
+
+BLOB_DIR = "blobs"  # blobs/<sha256>, inside the file store
+INDEX_NAME = "index.db"
+CACHE_BYTES = 64 * 1024 * 1024  # in-memory LRU of recently downloaded files
+CACHE_MAX_FILE = 8 * 1024 * 1024  # bigger files are always streamed from disk
+MAX_STORE_BYTES = 5 * 1024 * 1024 * 1024
+MAX_FILE_AGE = 30 * 24 * 60 * 60  # files not downloaded for this long are removed
+
+
+def valid_file_id(file_id):
+    """True for an id shaped like ContentStore.make_file_id's: 16 hex characters, "_", a file name"""
+    return (isinstance(file_id, str) and len(file_id) > 17 and file_id[16] == "_"
+            and all(c in "0123456789abcdef" for c in file_id[:16]) and "/" not in file_id)
+
+
+class FileInfo:
+    """Metadata for one shared file"""
+
+    __slots__ = ("file_id", "sha256", "filename", "size")
+
+    def __init__(self, file_id, sha256, filename, size):
+        self.file_id = file_id
+        self.sha256 = sha256
+        self.filename = filename
+        self.size = size
+
+
+class CacheEntry:
+    __slots__ = ("data", "b64")
+
+    def __init__(self, data):
+        self.data = data
+        self.b64 = None  # filled in the first time a legacy file_data payload is needed
+
+    def size(self):
+        return len(self.data) + (len(self.b64) if self.b64 else 0)
+
+
+class ContentStore:
+    """Deduplicated uploads: blobs keyed by SHA-256, a metadata index, and an LRU of hot files"""
+
+    def __init__(self, store, cache_bytes=CACHE_BYTES, cache_max_file=CACHE_MAX_FILE,
+                 max_bytes=MAX_STORE_BYTES, max_age=MAX_FILE_AGE):
+        self.store = store
+        self.cache_bytes = cache_bytes
+        self.cache_max_file = cache_max_file
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.cache = collections.OrderedDict()  # sha256 -> CacheEntry, oldest first
+        self.cached = 0  # bytes held in the cache
+        self.hits = 0
+        self.misses = 0
+        # One thread owns the index connection
+        self.executor = ThreadPoolExecutor(1, "content-index")
+        self.db = None
+        os.makedirs(store.path(BLOB_DIR), exist_ok=True)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def blob_name(self, sha256):
+        return os.path.join(BLOB_DIR, sha256)
+
+    # Index
+
+    def _open(self):
+        db = sqlite3.connect(self.store.path(INDEX_NAME), check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "file_id TEXT PRIMARY KEY, "
+            "sha256 TEXT NOT NULL, "
+            "filename TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "uploader TEXT, "
+            "created REAL NOT NULL, "
+            "accessed REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        db.execute("CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed)")
+        db.execute("CREATE INDEX IF NOT EXISTS files_uploader ON files (uploader)")
+        db.commit()
+        return db
+
+    async def start(self):
+        self.db = await self._run(self._open)
+        await self.migrate()
+
+    def _insert(self, file_id, sha256, filename, size, uploader):
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (file_id, sha256, filename, size, uploader, now, now)
+            )
+
+    def _lookup(self, file_id):
+        row = self.db.execute(
+            "SELECT file_id, sha256, filename, size FROM files WHERE file_id = ?", (file_id,)
+        ).fetchone()
+        if row:
+            with self.db:
+                self.db.execute("UPDATE files SET accessed = ? WHERE file_id = ?", (time.time(), file_id))
+            return FileInfo(*row)
+        return None
+
+    async def lookup(self, file_id):
+        """Metadata for a file_id, or None; counts as an access for retention"""
+        return await self._run(self._lookup, file_id)
+
+    def _usage(self, uploader):
+        return self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM files WHERE uploader = ?", (uploader,)
+        ).fetchone()[0]
+
+    async def usage(self, uploader):
+        """Bytes of files uploader has shared, each file counted even if its blob is shared"""
+        return await self._run(self._usage, uploader)
+
+    # Adding files
+
+    @staticmethod
+    def make_file_id(sha256, filename):
+        # Same content and name always gets the same id; the part after "_" is the filename
+        return f"{sha256[:16]}_{filename}"
+
+    def _add_file(self, name, filename, uploader, sha256):
+        path = self.store.path(name)
+        if sha256 is None:
+            sha256 = hash_file(path)
+        size = os.path.getsize(path)
+        blob = self.store.path(self.blob_name(sha256))
+        if os.path.exists(blob):
+            os.remove(path)  # already stored once
+        else:
+            os.replace(path, blob)
+        file_id = self.make_file_id(sha256, filename)
+        self._insert(file_id, sha256, filename, size, uploader)
+        return file_id
+
+    async def add_file(self, name, filename, uploader, sha256=None):
+        """Move a finished file in the store into a blob and index it; returns file_id"""
+        return await self._run(self._add_file, name, filename, uploader, sha256)
+
+    def _migrate(self):
+        """Index files saved as uploads/<time>_<name> before the content store existed"""
+        moved = 0
+        for entry in os.scandir(self.store.root):
+            if not entry.is_file() or entry.name.startswith(INDEX_NAME) or "_" not in entry.name:
+                continue
+            try:
+                sha256 = hash_file(entry.path)
+                size = entry.stat().st_size
+                blob = self.store.path(self.blob_name(sha256))
+                if os.path.exists(blob):
+                    os.remove(entry.path)
+                else:
+                    os.replace(entry.path, blob)
+            except FileNotFoundError:
+                continue  # another worker got to it first
+            # Keep the old id so earlier /download links still work
+            self._insert(entry.name, sha256, entry.name.split("_", 1)[1], size, None)
+            moved += 1
+        return moved
+
+    async def migrate(self):
+        moved = await self._run(self._migrate)
+        if moved:
+            print(f"Moved {moved} existing uploads into the content store")
+
+    # Reading files
+
+    def _cache_get(self, sha256):
+        entry = self.cache.get(sha256)
+        if entry is not None:
+            self.cache.move_to_end(sha256)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def _cache_put(self, sha256, data):
+        if len(data) > self.cache_max_file:
+            return None
+        if sha256 in self.cache:
+            return self.cache[sha256]
+        entry = CacheEntry(data)
+        self.cache[sha256] = entry
+        self.cached += len(data)
+        self._cache_evict()
+        return entry
+
+    def _cache_evict(self):
+        """Drop least recently used entries until the cache fits cache_bytes"""
+        while self.cached > self.cache_bytes and self.cache:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached -= evicted.size()
+
+    async def read(self, info):
+        """Whole file contents, from the cache when possible"""
+        entry = self._cache_get(info.sha256)
+        if entry:
+            return entry.data
+        data = await self.store.read(self.blob_name(info.sha256))
+        self._cache_put(info.sha256, data)
+        return data
+
+    async def read_b64(self, info):
+        """Base64 text of a file for legacy file_data replies, encoded at most once while cached"""
+        entry = self._cache_get(info.sha256)
+        if entry is None:
+            data = await self.store.read(self.blob_name(info.sha256))
+            entry = self._cache_put(info.sha256, data)
+            if entry is None:
+                return base64.b64encode(data).decode("utf-8")
+        if entry.b64 is None:
+            entry.b64 = base64.b64encode(entry.data).decode("utf-8")
+            self.cached += len(entry.b64)
+            self._cache_evict()
+        return entry.b64
+
+    async def read_chunks(self, info, offset=0, chunk_size=64 * 1024):
+        """Yield (offset, chunk) pairs, from memory for hot small files"""
+        entry = self._cache_get(info.sha256)
+        if entry is None and info.size <= self.cache_max_file:
+            data = await self.store.read(self.blob_name(info.sha256))
+            entry = self._cache_put(info.sha256, data)
+        if entry is not None:
+            view = memoryview(entry.data)
+            for start in range(offset, len(view), chunk_size):
+                yield start, view[start:start + chunk_size]
+            return
+        async for item in self.store.read_chunks(self.blob_name(info.sha256), offset, chunk_size):
+            yield item
+
+    # Retention
+
+    def _enforce_retention(self):
+        removed = []
+        with self.db:
+            # Files nobody has downloaded for max_age
+            cutoff = time.time() - self.max_age
+            removed += [row[0] for row in self.db.execute(
+                "SELECT sha256 FROM files WHERE accessed < ?", (cutoff,)
+            )]
+            self.db.execute("DELETE FROM files WHERE accessed < ?", (cutoff,))
+
+            # Then least recently accessed until unique blob bytes fit max_bytes
+            total = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT sha256, size FROM files)"
+            ).fetchone()[0]
+            if total > self.max_bytes:
+                for file_id, sha256, size in self.db.execute(
+                    "SELECT file_id, sha256, size FROM files ORDER BY accessed"
+                ).fetchall():
+                    self.db.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+                    removed.append(sha256)
+                    still_used = self.db.execute(
+                        "SELECT 1 FROM files WHERE sha256 = ? LIMIT 1", (sha256,)
+                    ).fetchone()
+                    if not still_used:
+                        total -= size
+                    if total <= self.max_bytes:
+                        break
+
+        # Delete blobs no file points at any more
+        deleted = []
+        for sha256 in set(removed):
+            if not self.db.execute("SELECT 1 FROM files WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone():
+                try:
+                    os.remove(self.store.path(self.blob_name(sha256)))
+                except FileNotFoundError:
+                    pass
+                deleted.append(sha256)
+        return deleted
+
+    async def enforce_retention(self):
+        """Drop expired files, then the least recently used ones over the size cap"""
+        for sha256 in await self._run(self._enforce_retention):
+            entry = self.cache.pop(sha256, None)
+            if entry:
+                self.cached -= entry.size()
+
+    def cache_stats(self):
+        return {
+            "files": len(self.cache),
+            "bytes": self.cached,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    async def close(self):
+        if self.db:
+            await self._run(self.db.close)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from rooms import DEFAULT_ROOM
+
+BATCH_SIZE = 500  # flush once this many messages are waiting
+FLUSH_INTERVAL = 0.05  # seconds between background flushes
+MAX_PAGE = 100
+MAX_PAGE_BYTES = 256 * 1024  # a page stops early past this many bytes of messages, so it fits one frame
+
+
+class HistoryStore:
+    """Append-only chat log in SQLite (WAL), written in batches off the event loop"""
+
+    def __init__(self, path="history.db", batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []  # (room, timestamp, encoded message) not yet written
+        # One thread owns the connection, so reads always see earlier writes
+        self.executor = ThreadPoolExecutor(1, "history")
+        self.db = None
+        self.task = None
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")  # fsync at checkpoints, not every commit
+        db.execute("PRAGMA busy_timeout=5000")  # other worker processes share the file
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "ts REAL NOT NULL, "
+            "body TEXT NOT NULL, "
+            f"room TEXT NOT NULL DEFAULT '{DEFAULT_ROOM}')"
+        )
+        # Logs written before rooms existed belong to the default room
+        columns = [row[1] for row in db.execute("PRAGMA table_info(messages)")]
+        if "room" not in columns:
+            db.execute(f"ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT '{DEFAULT_ROOM}'")
+        db.execute("CREATE INDEX IF NOT EXISTS messages_room_seq ON messages (room, seq)")
+        db.commit()
+        return db
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def start(self):
+        self.db = await self._run(self._open)
+        self.task = asyncio.create_task(self._flush_loop())
+
+    def append(self, message, room=DEFAULT_ROOM):
+        """Queue a message for the next batch write"""
+        self.pending.append((room, time.time(), json.dumps(message)))
+        if len(self.pending) >= self.batch_size:
+            asyncio.create_task(self.flush())
+
+    def _write(self, batch):
+        with self.db:
+            self.db.executemany("INSERT INTO messages (room, ts, body) VALUES (?, ?, ?)", batch)
+
+    async def flush(self):
+        """Write everything queued so far in one transaction"""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        await self._run(self._write, batch)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                print(f"History write failed: {e}")
+
+    def _page(self, room, before, limit):
+        if before is None:
+            rows = self.db.execute(
+                "SELECT seq, ts, body FROM messages WHERE room = ? ORDER BY seq DESC LIMIT ?",
+                (room, limit + 1)
+            ).fetchall()
+        else:
+            rows = self.db.execute(
+                "SELECT seq, ts, body FROM messages WHERE room = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (room, before, limit + 1)
+            ).fetchall()
+        return rows
+
+    async def page(self, before=None, limit=50, room=DEFAULT_ROOM, max_bytes=MAX_PAGE_BYTES):
+        """Up to limit messages in room older than seq before (newest if None), oldest first
+
+        The page is cut short once its messages pass max_bytes (it always has
+        at least one), with more set so the client can ask for the rest.
+        """
+        limit = max(1, min(limit, MAX_PAGE))
+        await self.flush()
+        rows = await self._run(self._page, room, before, limit)
+        more = len(rows) > limit
+        messages = []
+        size = 0
+        for seq, ts, body in rows[:limit]:
+            size += len(body)
+            if messages and size > max_bytes:
+                more = True
+                break
+            message = json.loads(body)
+            message["seq"] = seq
+            message["timestamp"] = ts
+            messages.append(message)
+        messages.reverse()
+        return messages, more
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+        if self.db:
+            await self._run(self.db.close)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,211 @@
+import asyncio
+import bisect
+import collections
+import sys
+import threading
+import time
+import traceback
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    """Monotonic count, optionally split by one label"""
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {} if label else {None: 0}  # label value -> count
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_value, value in self.values.items():
+            yield f"{self.name}{_labels(self.label, label_value)} {value}"
+
+    def snapshot(self):
+        if self.label is None:
+            return self.values.get(None, 0)
+        return dict(self.values)
+
+
+class Gauge:
+    """Value read from a callback when metrics are collected"""
+
+    def __init__(self, name, help, read, label=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label  # set when read() returns {label value: value}
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        value = self.read()
+        if isinstance(value, dict):
+            for label_value, v in value.items():
+                yield f"{self.name}{_labels(self.label, label_value)} {v}"
+        else:
+            yield f"{self.name} {value}"
+
+    def snapshot(self):
+        return self.read()
+
+
+class Histogram:
+    """Fixed buckets allocated up front; observe is a bisect and two adds"""
+
+    __slots__ = ("name", "help", "bounds", "counts", "sum", "count")
+
+    def __init__(self, name, help, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            yield f'{self.name}_bucket{{le="{bound}"}} {total}'
+        yield f'{self.name}_bucket{{le="+Inf"}} {self.count}'
+        yield f"{self.name}_sum {self.sum}"
+        yield f"{self.name}_count {self.count}"
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip([*map(str, self.bounds), "+Inf"], self.counts))
+        }
+
+
+def _labels(label, value):
+    if label is None or value is None:
+        return ""
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'{{{label}="{value}"}}'
+
+
+class Registry:
+    """All metrics for one server process"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, label=None):
+        return self.metrics.setdefault(name, Counter(name, help, label))
+
+    def gauge(self, name, help, read, label=None):
+        return self.metrics.setdefault(name, Gauge(name, help, read, label))
+
+    def histogram(self, name, help, bounds=LATENCY_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, help, bounds))
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+async def watch_loop_lag(histogram, interval=0.1):
+    """Record how late the event loop wakes a sleeping task"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - start - interval))
+
+
+async def serve_http(registry, host, port):
+    """Plain-text /metrics endpoint"""
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass  # skip headers
+            if request.split(b" ")[1:2] == [b"/metrics"]:
+                body = registry.render().encode()
+                status = b"200 OK"
+            else:
+                body = b"Not found\n"
+                status = b"404 Not Found"
+            writer.write(
+                b"HTTP/1.1 " + status + b"\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+class SamplingProfiler:
+    """Background thread that samples the event loop thread's stack
+
+    Off by default; start() it to find out which handlers the loop is
+    spending its time in. top() returns the most frequently seen frames.
+    """
+
+    def __init__(self, interval=0.01, depth=8):
+        self.interval = interval
+        self.depth = depth
+        self.samples = collections.Counter()
+        self.total = 0
+        self.target = threading.get_ident()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame, limit=self.depth)
+            self.samples[" <- ".join(
+                f"{entry.name} ({entry.filename.rsplit('/', 1)[-1]}:{entry.lineno})"
+                for entry in reversed(stack)
+            )] += 1
+            self.total += 1
+
+    def top(self, n=20):
+        if not self.total:
+            return []
+        return [
+            {"stack": stack, "share": count / self.total}
+            for stack, count in self.samples.most_common(n)
+        ]
@@ -0,0 +1,83 @@
+import asyncio
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+
+POSTPROCESS_WORKERS = 2
+HOOK_TIMEOUT = 60  # seconds a hook gets before the upload is rejected
+
+
+class PostProcessor:
+    """Checks run on every finished upload before it is shared (virus scan, thumbnails, ...)
+
+    A hook is called as hook(path, filename) and returns None to accept the
+    file or a reason string to reject it. Coroutine functions run on the event
+    loop; plain functions run on a small thread pool so a slow scan doesn't
+    hold up chat.
+    """
+
+    def __init__(self, workers=POSTPROCESS_WORKERS, timeout=HOOK_TIMEOUT):
+        self.hooks = []
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = None  # created with the first blocking hook
+        self.checked = 0
+        self.rejected = 0
+
+    def add(self, hook):
+        self.hooks.append(hook)
+        if not asyncio.iscoroutinefunction(hook) and self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers, "postprocess")
+
+    async def _call(self, hook, path, filename):
+        if asyncio.iscoroutinefunction(hook):
+            return await hook(path, filename)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, hook, path, filename)
+
+    async def check(self, path, filename):
+        """None if every hook accepts the file, else the first rejection reason"""
+        if not self.hooks:
+            return None
+        self.checked += 1
+        for hook in self.hooks:
+            try:
+                reason = await asyncio.wait_for(self._call(hook, path, filename), self.timeout)
+            except asyncio.TimeoutError:
+                reason = "File check timed out."
+            except Exception as e:
+                print(f"Upload hook {getattr(hook, '__name__', hook)} failed: {e}")
+                reason = "File check failed."
+            if reason:
+                self.rejected += 1
+                return reason
+        return None
+
+    def stats(self):
+        return {"checked": self.checked, "rejected": self.rejected}
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+
+def command_hook(command):
+    """Hook that runs an external scanner, e.g. "clamdscan --no-summary"; a non-zero exit rejects
+
+    The file's path is appended as the last argument.
+    """
+    args = shlex.split(command)
+
+    async def run_command(path, filename):
+        process = await asyncio.create_subprocess_exec(
+            *args, path, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+        )
+        try:
+            output, _ = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            print(f"{args[0]} rejected {filename}: {output.decode(errors='replace').strip()}")
+            return "File rejected by scan."
+        return None
+
+    return run_command
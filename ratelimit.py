@@ -0,0 +1,101 @@
+import time
+
+
+class TokenBucket:
+    """Refills at rate tokens per second up to burst; O(1) time and memory per check"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost=1):
+        """Spend cost tokens if they're available"""
+        self._refill(time.monotonic())
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def reserve(self, cost):
+        """Spend cost tokens, going into debt if needed; returns seconds to wait"""
+        self._refill(time.monotonic())
+        self.tokens -= cost
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimiter:
+    """Named per-user and server-wide token buckets with hit counters"""
+
+    def __init__(self):
+        self.limits = {}  # name -> (rate, burst)
+        self.user_buckets = {}  # username -> {name: TokenBucket}
+        self.global_buckets = {}  # name -> TokenBucket
+        self.checks = {}  # name -> number of checks
+        self.hits = {}  # name -> number of times the limit fired
+
+    def add(self, name, rate, burst):
+        """Define a per-user limit; cost is messages or bytes depending on the caller"""
+        self.limits[name] = (rate, burst)
+        self.checks[name] = 0
+        self.hits[name] = 0
+
+    def add_global(self, name, rate, burst):
+        """Define a limit shared by every user on this server"""
+        self.global_buckets[name] = TokenBucket(rate, burst)
+        self.checks[name] = 0
+        self.hits[name] = 0
+
+    def _bucket(self, username, name):
+        buckets = self.user_buckets.get(username)
+        if buckets is None:
+            buckets = self.user_buckets[username] = {}
+        bucket = buckets.get(name)
+        if bucket is None:
+            bucket = buckets[name] = TokenBucket(*self.limits[name])
+        return bucket
+
+    def allow(self, username, name, cost=1):
+        """True if username may spend cost against limit name"""
+        if name not in self.limits:
+            return True
+        self.checks[name] += 1
+        if self._bucket(username, name).take(cost):
+            return True
+        self.hits[name] += 1
+        return False
+
+    def delay(self, username, name, cost):
+        """Charge cost against limit name and return how long to wait before continuing"""
+        if name not in self.limits:
+            return 0.0
+        self.checks[name] += 1
+        wait = self._bucket(username, name).reserve(cost)
+        if wait:
+            self.hits[name] += 1
+        return wait
+
+    def allow_global(self, name, cost=1):
+        """True if the server-wide limit name has room for cost"""
+        bucket = self.global_buckets.get(name)
+        if bucket is None:
+            return True
+        self.checks[name] += 1
+        if bucket.take(cost):
+            return True
+        self.hits[name] += 1
+        return False
+
+    def forget(self, username):
+        """Drop a disconnected user's buckets"""
+        self.user_buckets.pop(username, None)
+
+    def stats(self):
+        return {name: {"checks": self.checks[name], "hits": self.hits[name]} for name in self.checks}
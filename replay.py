@@ -0,0 +1,118 @@
+import collections
+import heapq
+import itertools
+import json
+import time
+
+ROOM_EVENTS = 500  # recent events kept per room
+USER_EVENTS = 100  # recent direct events kept per user
+ROOM_BYTES = 1024 * 1024  # and at most this much JSON per room, whichever limit is hit first
+USER_BYTES = 256 * 1024
+MAX_RINGS = 1000  # rooms and users with a ring; the least recently used one is dropped past this
+EVERYONE = "*"  # ring for events sent to all users (not a valid room name)
+
+
+def user_ring(username):
+    """Ring name for events addressed to one user ("@" can't appear in a room name)"""
+    return f"@{username}"
+
+
+class Ring:
+    """Recent (seq, event, size) entries, oldest first, and the newest seq that fell off the end
+
+    Events are dropped from the old end once there are more than max_events
+    of them or they add up to more than max_bytes; the newest is always kept.
+    """
+    __slots__ = ("events", "floor", "max_events", "max_bytes", "bytes")
+
+    def __init__(self, max_events, floor, max_bytes):
+        self.events = collections.deque()
+        self.floor = floor
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    def append(self, seq, message, size):
+        self.events.append((seq, message, size))
+        self.bytes += size
+        while len(self.events) > self.max_events or (self.bytes > self.max_bytes and len(self.events) > 1):
+            self.floor, _, dropped = self.events.popleft()
+            self.bytes -= dropped
+
+    def since(self, after):
+        """Events newer than after, oldest first"""
+        newer = list(itertools.takewhile(lambda event: event[0] > after, reversed(self.events)))
+        newer.reverse()
+        return newer
+
+
+class ReplayLog:
+    """Numbers every published event and keeps the recent ones for reconnecting clients
+
+    Sequence numbers start at the current time in microseconds and go up by
+    one per event, so they keep increasing across server restarts and a
+    client's last-seen number from before a restart reads as too old to replay.
+    A room's events are stored once in the room's ring rather than once per
+    member; a user's replay is their rooms' rings plus their own ring of
+    direct events, merged by sequence number.
+    """
+
+    def __init__(self, room_events=ROOM_EVENTS, user_events=USER_EVENTS, max_rings=MAX_RINGS,
+                 room_bytes=ROOM_BYTES, user_bytes=USER_BYTES):
+        self.room_events = room_events
+        self.user_events = user_events
+        self.room_bytes = room_bytes
+        self.user_bytes = user_bytes
+        self.max_rings = max_rings
+        self.seq = time.time_ns() // 1000
+        self.floor = self.seq  # newest seq in any dropped ring; anything older is gone
+        self.rings = collections.OrderedDict()  # ring name -> Ring, least recently written first
+
+    def record(self, message, room=None, user=None):
+        """Copy of message with the next sequence number as "event_seq", remembered for replay"""
+        self.seq += 1
+        message = dict(message, event_seq=self.seq)
+        if user is not None:
+            name, max_events, max_bytes = user_ring(user), self.user_events, self.user_bytes
+        elif room is not None:
+            name, max_events, max_bytes = room, self.room_events, self.room_bytes
+        else:
+            name, max_events, max_bytes = EVERYONE, self.room_events, self.room_bytes
+
+        ring = self.rings.get(name)
+        if ring is None:
+            ring = self.rings[name] = Ring(max_events, self.floor, max_bytes)
+            if len(self.rings) > self.max_rings:
+                _, dropped = self.rings.popitem(last=False)
+                if dropped.events:
+                    self.floor = max(self.floor, dropped.events[-1][0])
+        else:
+            self.rings.move_to_end(name)
+        ring.append(self.seq, message, len(json.dumps(message)))
+        return message
+
+    def since(self, username, rooms, after):
+        """Events for a member of rooms newer than seq after, and the rooms whose ring doesn't reach back that far
+
+        A missed room's events are left out: the client gets a history page
+        for it instead, which already holds them.
+        """
+        lists = []
+        missed = []
+        for name in [EVERYONE, user_ring(username), *rooms]:
+            ring = self.rings.get(name)
+            if name in rooms and (ring.floor if ring else self.floor) > after:
+                missed.append(name)
+                continue
+            if ring:
+                lists.append(ring.since(after))
+        events = [message for _, message, _ in heapq.merge(*lists, key=lambda event: event[0])]
+        return events, missed
+
+    def stats(self):
+        return {
+            "seq": self.seq,
+            "rings": len(self.rings),
+            "events": sum(len(ring.events) for ring in self.rings.values()),
+            "bytes": sum(ring.bytes for ring in self.rings.values())
+        }
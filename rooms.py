@@ -0,0 +1,93 @@
+import asyncio
+import re
+
+DEFAULT_ROOM = "general"  # everyone joins on login; messages without a room go here
+MAX_ROOMS_PER_USER = 20
+ROOM_NAME = re.compile(r"^[a-z0-9_-]{1,32}$")
+PRESENCE_WINDOW = 0.1  # seconds of joins/leaves folded into one users_diff
+
+
+def valid_room(name):
+    return isinstance(name, str) and ROOM_NAME.match(name) is not None
+
+
+class RoomIndex:
+    """Room membership for this process's users, so a room message only touches its members"""
+
+    def __init__(self):
+        self.members = {}  # room -> {username: Session}; each session keeps its own set of rooms
+
+    def join(self, room, session):
+        """Add a user to a room; False if they were already in it"""
+        members = self.members.setdefault(room, {})
+        if session.username in members:
+            return False
+        members[session.username] = session
+        session.rooms.add(room)
+        return True
+
+    def leave(self, room, session):
+        """Remove a user from a room; False if they weren't in it"""
+        members = self.members.get(room)
+        if not members or members.pop(session.username, None) is None:
+            return False
+        if not members:
+            del self.members[room]
+        session.rooms.discard(room)
+        return True
+
+    def leave_all(self, session):
+        """Remove a user from every room; returns the rooms they were in"""
+        rooms = list(session.rooms)
+        for room in rooms:
+            self.leave(room, session)
+        return rooms
+
+    def local_members(self, room):
+        """Sessions of this process's users in a room"""
+        return self.members.get(room, {}).values()
+
+
+class PresenceDiffs:
+    """Collects joins and leaves per room and publishes them as one diff per window
+
+    A reconnect storm of N users then costs each member one users_diff frame
+    per window instead of N separate join notices.
+    """
+
+    def __init__(self, publish, window=PRESENCE_WINDOW):
+        self.publish = publish  # async publish(room, joined, left)
+        self.window = window
+        self.pending = {}  # room -> {username: True if joined, False if left}
+        self.task = None
+
+    def joined(self, room, username):
+        self._add(room, username, True)
+
+    def left(self, room, username):
+        self._add(room, username, False)
+
+    def _add(self, room, username, present):
+        changes = self.pending.setdefault(room, {})
+        if changes.get(username) is (not present):
+            del changes[username]  # joined and left again (or the reverse) within the window
+        else:
+            changes[username] = present
+        if self.task is None:
+            self.task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.task = None
+        pending, self.pending = self.pending, {}
+        for room, changes in pending.items():
+            if not changes:
+                continue
+            try:
+                await self.publish(
+                    room,
+                    [u for u, present in changes.items() if present],
+                    [u for u, present in changes.items() if not present]
+                )
+            except Exception as e:
+                print(f"Presence update failed: {e}")
@@ -1,211 +1,881 @@
+import argparse
 import asyncio
-import json
 import ssl
 import websockets
 import time
 import base64
 import os
+import signal
+import socket
+import sys
+import multiprocessing
+from asyncio import sslproto
+import codec as codecs
+import compression
+import metrics
+from auth import Authenticator
+from broadcast import BATCH_WINDOW, Broadcaster, DROP_OLDEST
+from bus import LocalBus, SocketBus, run_broker
+from content import ContentStore, valid_file_id
+from history import HistoryStore
+from postprocess import PostProcessor, command_hook
+from ratelimit import RateLimiter
+from rooms import DEFAULT_ROOM, MAX_ROOMS_PER_USER, PRESENCE_WINDOW, PresenceDiffs, RoomIndex, valid_room
+from session import Connection, Session
+from storage import FileStore, THREADED
+from transfer import (
+    CHUNK_SIZE, PARTIAL_DIR, USER_QUOTA, TransferError, UploadManager, is_chunk, new_transfer_id, pack_chunk,
+    valid_transfer_id
+)
 
-# Create uploads directory
-os.makedirs("uploads", exist_ok=True)
+# Uploads store: file I/O runs on a thread pool ("threaded") or inline on the loop ("inline")
+STORAGE_MODE = THREADED
+STORAGE_WORKERS = 4
+MAX_TRANSFERS = 16  # concurrent streamed transfers before senders have to wait
+MAX_TRANSFERS_PER_USER = 4
+SLOT_TIMEOUT = 30  # seconds an upload or download waits for a free slot before it's refused
+STALL_TIMEOUT = 30  # seconds a transfer can make no progress before its slot is taken back
+store = FileStore("uploads", STORAGE_MODE, STORAGE_WORKERS, MAX_TRANSFERS, MAX_TRANSFERS_PER_USER)
 
-# User credentials
-USER_DB = {
+# Shared files are stored once per SHA-256, with an LRU of recently downloaded ones in memory
+CACHE_BYTES = 64 * 1024 * 1024
+MAX_STORE_BYTES = 5 * 1024 * 1024 * 1024
+MAX_FILE_AGE = 30 * 24 * 60 * 60  # seconds since last download
+RETENTION_INTERVAL = 60 * 60
+content = ContentStore(store, CACHE_BYTES, max_bytes=MAX_STORE_BYTES, max_age=MAX_FILE_AGE)
+
+# Uploads: declared, checked against MAX_FILE_SIZE and the owner's quota, streamed
+# to a partial file while hashed, verified, run through the postprocess hooks
+# (--scan-command) and only then moved into the content store
+MAX_INLINE_FILE = 512 * 1024  # largest file sent or fetched as one base64 message ("file", "file_request")
+postprocessor = PostProcessor()
+uploads = UploadManager(store, content.usage, USER_QUOTA, postprocessor)
+
+# User credentials: salted scrypt hashes in USERS_PATH (manage with "python auth.py"),
+# checked on a thread pool; logins return a signed session token for resuming
+USERS_PATH = "users.json"
+SECRET_PATH = "session.key"
+DEFAULT_USERS = {  # written to USERS_PATH, hashed, the first time the server starts
     "joe": "joe123",
     "bob": "bob123",
     "jim": "jim123",
     "lee": "lee123",
     "eve": "eve123"
 }
+BENCH_SCRYPT_N = 2 ** 10  # bench accounts hash cheaply so load tests measure the server
+authenticator = Authenticator(USERS_PATH, SECRET_PATH)
 
 # Active connections
-active_users = {}  # username -> websocket
+active_users = {}  # username -> Session
+
+# Connection profiles: websockets buffer limits and what each connection keeps around.
+# "dense" (--dense) is for tens of thousands of mostly idle connections;
+# "python bench.py --spawn-server --idle --dense" reports the RSS each one costs.
+PROFILES = {
+    "default": {
+        "max_size": 1024 * 1024,  # largest incoming message
+        "max_queue": 16,  # incoming frames buffered before reading from the socket pauses
+        "write_limit": 32 * 1024,  # outgoing bytes buffered before a send waits
+        "send_queue": 256,  # outbound frames queued per client before OVERFLOW_POLICY applies
+        "tls_read_buffer": None,  # asyncio's own: 256KB per connection
+        "context_takeover": True  # see compression.py
+    },
+    "dense": {
+        "max_size": 2 * CHUNK_SIZE,  # chunk frames and chat; no base64 "file" messages
+        "max_queue": 4,
+        "write_limit": 8 * 1024,
+        "send_queue": 64,
+        "tls_read_buffer": 16 * 1024,  # one TLS record
+        "context_takeover": False  # no zlib state kept between messages
+    }
+}
+profile = PROFILES["default"]
 
-# Rate limiting
-message_timestamps = {}  # username -> list of timestamps
+# Liveness: clients ping (WebSocket pings, see client.py) and the server closes
+# connections that have sent nothing at all for IDLE_TIMEOUT
+IDLE_TIMEOUT = 60
+IDLE_CHECK_INTERVAL = 10
+AUTH_TIMEOUT = 10  # seconds a new connection has to log in
+
+# Room membership of this process's users; room messages only go to members
+rooms = RoomIndex()
+
+# Rate limiting: token buckets per user and message type, per user upload bytes,
+# and one server-wide bucket protecting the broadcast path
 MAX_MESSAGES = 5
 WINDOW_SECONDS = 10
+MAX_CHAT_CHARS = 4000  # longest chat or direct message; keeps history pages and replay rings small
+MESSAGE_LIMITS = {  # msg_type -> (messages per second, burst)
+    "chat": (MAX_MESSAGES / WINDOW_SECONDS, MAX_MESSAGES),
+    "direct": (MAX_MESSAGES / WINDOW_SECONDS, MAX_MESSAGES),
+    "join": (1, 5),
+    "leave": (1, 5),
+    "file": (MAX_MESSAGES / WINDOW_SECONDS, MAX_MESSAGES),
+    "upload_start": (MAX_MESSAGES / WINDOW_SECONDS, MAX_MESSAGES),
+    "file_request": (2, 10),
+    "download_request": (2, 10),
+    "history_request": (2, 10)
+}
+UPLOAD_BYTES_PER_SECOND = 5 * 1024 * 1024
+UPLOAD_BYTES_BURST = 20 * 1024 * 1024
+BROADCAST_TYPES = ["chat", "file"]
+BROADCASTS_PER_SECOND = 500
+BROADCAST_BURST = 1000
 
-async def broadcast(message):
-    """Send message to all connected users"""
-    data = json.dumps(message)
-    for websocket in active_users.values():
-        try:
-            await websocket.send(data)
-        except:
-            pass
+limiter = RateLimiter()
+for name, (rate, burst) in MESSAGE_LIMITS.items():
+    limiter.add(name, rate, burst)
+limiter.add("upload_bytes", UPLOAD_BYTES_PER_SECOND, UPLOAD_BYTES_BURST)
+limiter.add_global("broadcast", BROADCASTS_PER_SECOND, BROADCAST_BURST)
+
+# Instrumentation: counters and fixed-bucket histograms, exposed through the
+# "metrics" message and a Prometheus-style text endpoint on METRICS_PORT
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100  # worker N listens on METRICS_PORT + N; None to disable
+SLOW_HANDLER_SECONDS = 0.1  # log handlers slower than this
+PROFILE_INTERVAL = None  # e.g. 0.01 to run the sampling profiler
+MESSAGE_TYPES = [  # types with a handler; anything else is counted as "other"
+    "chat", "direct", "join", "leave", "rooms", "users", "file", "file_request", "upload_start",
+    "download_request", "heartbeat", "history_request", "rate_limit_stats", "queue_stats", "metrics"
+]
+ADMIN_TYPES = ["rate_limit_stats", "queue_stats", "metrics"]
+ADMIN_USERS = ["joe"]  # may send ADMIN_TYPES; everyone else uses the local metrics endpoint
+registry = metrics.Registry()
+messages_in = registry.counter("chat_messages_in_total", "Frames received, by message type", "type")
+messages_out = registry.counter("chat_messages_out_total", "Frames queued for clients, by message type", "type")
+bytes_uploaded = registry.counter("chat_upload_bytes_total", "File bytes received")
+bytes_downloaded = registry.counter("chat_download_bytes_total", "File bytes sent")
+idle_evictions = registry.counter("chat_idle_evictions_total", "Connections closed for sending nothing in IDLE_TIMEOUT")
+slow_handlers = registry.counter("chat_slow_handlers_total", "Handlers slower than SLOW_HANDLER_SECONDS", "type")
+handler_seconds = registry.histogram("chat_handler_seconds", "Time to handle one incoming frame")
+broadcast_seconds = registry.histogram("chat_broadcast_seconds", "Time to encode and queue one broadcast")
+send_seconds = registry.histogram("chat_client_send_seconds", "Time from queueing a frame to it being written")
+auth_seconds = registry.histogram("chat_auth_seconds", "Time from connection to login")
+resumes = registry.counter("chat_resumes_total", "Reconnects that replayed missed events, by whether the replay reached back far enough", "result")
+replayed_events = registry.counter("chat_replayed_events_total", "Events replayed to reconnecting clients")
+loop_lag = registry.histogram("chat_event_loop_lag_seconds", "How late the event loop runs a 100ms timer")
+profiler = metrics.SamplingProfiler(PROFILE_INTERVAL) if PROFILE_INTERVAL else None
+
+# Outbound fan-out: per-client bounded queues (profile["send_queue"]), each drained by its own writer.
+# Clients that send "batch": true at login get bursts coalesced into batch frames.
+OVERFLOW_POLICY = DROP_OLDEST  # drop_oldest, disconnect or coalesce
+SEND_BATCH_WINDOW = BATCH_WINDOW  # seconds; None turns batching off for everyone
+broadcaster = Broadcaster(profile["send_queue"], OVERFLOW_POLICY, send_seconds, SEND_BATCH_WINDOW)
+
+registry.gauge("chat_active_connections", "Logged-in users on this process", lambda: len(active_users))
+registry.gauge("chat_rooms", "Rooms with members on this process", lambda: len(rooms.members))
+registry.gauge("chat_send_queue_depth", "Frames waiting in each user's send queue", lambda: {
+    name: session.queue.depth() for name, session in active_users.items()
+}, "user")
+registry.gauge("chat_rate_limit_hits", "Times each rate limit has fired", lambda: dict(limiter.hits), "limit")
+registry.gauge("chat_active_transfers", "Streamed transfers holding a slot", lambda: store.transfers)
+registry.gauge("chat_file_cache", "Hot file cache size and hit counts", content.cache_stats, "stat")
+registry.gauge("chat_upload_checks", "Uploads run through the postprocess hooks, and those rejected", postprocessor.stats, "stat")
+registry.gauge("chat_auth", "Password hashes, cache hits, token resumes and failures", authenticator.stats, "stat")
+
+# Compression: permessage-deflate with a per-frame policy (size threshold, no
+# recompressing zip/png/jpg transfers); "python compression.py" measures the settings
+compression_policy = compression.CompressionPolicy(context_takeover=profile["context_takeover"])
+broadcaster.shared = compression_policy.share
+registry.gauge("chat_compression", "Bytes in/out of permessage-deflate and time spent", lambda: compression_policy.stats(), "stat")
+
+# Scale-out: WORKERS > 1 runs that many processes sharing the port (SO_REUSEPORT),
+# with presence and fan-out going through a broker process on BUS_PORT
+WORKERS = 1
+BUS_HOST = "127.0.0.1"
+BUS_PORT = 8766
+bus = LocalBus()
+
+# Rooms: message types that name a room, and those that post into one (sender must be a member)
+ROOM_TYPES = ["chat", "file", "upload_start", "join", "leave", "users", "history_request"]
+POST_TYPES = ["chat", "file", "upload_start"]
+TEXT_TYPES = ["chat", "direct"]  # carry a "message" of at most MAX_CHAT_CHARS
+
+# Chat history: batched append-only SQLite log, with a backfill page sent on join
+HISTORY_PATH = "history.db"
+HISTORY_TYPES = ["chat", "file_shared"]
+JOIN_BACKFILL = 50
+history = HistoryStore(HISTORY_PATH)
+
+async def broadcast(message, key=None, room=None):
+    """Send message to the members of a room, or to all connected users if room is None"""
+    if room is not None and message.get("type") in HISTORY_TYPES:
+        history.append(message, room)
+    await bus.publish(message, key, room)
+
+async def send_direct(username, message):
+    """Send message to one user, on whichever worker they are connected to"""
+    await bus.publish(message, user=username)
+
+def deliver(message, key=None, room=None, user=None):
+    """Bus callback: fan a published message out to this process's recipients"""
+    started = time.perf_counter()
+    if user is not None:
+        session = active_users.get(user)
+        targets = (session,) if session else ()
+    elif room is not None:
+        targets = rooms.local_members(room)
+    else:
+        targets = active_users.values()
+    delivered = broadcaster.publish(message, (session.queue for session in targets), key)
+    broadcast_seconds.observe(time.perf_counter() - started)
+    messages_out.inc(message.get("type"), delivered)
+
+def send(session, message, key=None):
+    """Queue a message for one connected user"""
+    if broadcaster.send(session.queue, message, key):
+        messages_out.inc(message.get("type"))
+
+def queue_stats():
+    """Outbound queue depth and drop counts per user"""
+    return {name: session.queue.stats() for name, session in active_users.items()}
+
+async def publish_presence(room, joined, left):
+    """Send a room's members the users who joined and left during the last presence window"""
+    await broadcast({
+        "type": "users_diff",
+        "room": room,
+        "joined": joined,
+        "left": left
+    }, room=room)
+
+presence = PresenceDiffs(publish_presence, PRESENCE_WINDOW)
+
+async def send_room_state(session, room, backfill=True):
+    """Send a room's member list and, with backfill, its recent history"""
+    send(session, {
+        "type": "users_list",
+        "room": room,
+        "users": await bus.members(room)
+    }, key=f"users_list:{room}")
+    
+    if backfill:
+        messages, more = await history.page(None, JOIN_BACKFILL, room)
+        send(session, {
+            "type": "history",
+            "room": room,
+            "messages": messages,
+            "more": more
+        })
+
+async def join_room(session, room):
+    """Add a user to a room, announce them and send its member list and recent history"""
+    rooms.join(room, session)
+    await bus.join(session.username, room)
+    presence.joined(room, session.username)
+    
+    send(session, {"type": "joined", "room": room})
+    await send_room_state(session, room)
+
+async def resume_session(session, resume):
+    """Put a reconnecting user back in their rooms and replay the events they missed
+    
+    resume is {"after": last event_seq the client saw, "rooms": rooms it was in}.
+    Rooms whose recent events don't reach back that far get a history page instead
+    of a partial replay.
+    """
+    wanted = resume.get("rooms")
+    wanted = [room for room in wanted if valid_room(room)] if isinstance(wanted, list) else []
+    rejoin = list(dict.fromkeys(wanted))[:MAX_ROOMS_PER_USER] or [DEFAULT_ROOM]
+    after = resume.get("after")
+    if not isinstance(after, int):
+        # Never saw an event, so there is no point to replay from
+        for room in rejoin:
+            await join_room(session, room)
+        return
+    
+    replayed = 0
+    
+    def catch_up(events):
+        # Runs where live events for these rooms start arriving, so the replay
+        # neither misses nor repeats any of them
+        nonlocal replayed
+        for room in rejoin:
+            rooms.join(room, session)
+        for event in events:
+            send(session, event)
+        replayed = len(events)
+    
+    missed = await bus.replay(session.username, rejoin, after, catch_up)
+    resumes.inc("missed" if missed else "complete")
+    replayed_events.inc(amount=replayed)
+    for room in rejoin:
+        presence.joined(room, session.username)
+        await send_room_state(session, room, backfill=room in missed)
+    
+    send(session, {
+        "type": "resumed",
+        "rooms": rejoin,
+        "replayed": replayed,
+        "missed": missed
+    })
+
+async def finish_upload(session, upload, room):
+    """Verify a completed streamed upload, move it into place and announce it"""
+    try:
+        sha256 = await uploads.finish(upload)
+    except TransferError as e:
+        send(session, {
+            "type": "upload_error",
+            "upload_id": upload.upload_id,
+            "message": str(e)
+        })
+        return
+    file_id = await content.add_file(upload.name, upload.filename, session.username, sha256)
+    send(session, {
+        "type": "upload_progress",
+        "upload_id": upload.upload_id,
+        "received": upload.received,
+        "size": upload.size
+    })
+    await broadcast({
+        "type": "file_shared",
+        "room": room,
+        "from": session.username,
+        "filename": upload.filename,
+        "file_id": file_id
+    }, room=room)
+
+def track_transfer(session, task):
+    """Keep a transfer task on the session so it's cancelled on disconnect"""
+    if session.transfers is None:
+        session.transfers = set()
+    session.transfers.add(task)
+    task.add_done_callback(session.transfers.discard)
+
+async def ready_upload(session, upload, room):
+    """Wait for a transfer slot, off the receive loop, then tell the client to start sending"""
+    try:
+        await uploads.reserve(upload, SLOT_TIMEOUT)
+    except TransferError as e:
+        session.upload_rooms.pop(upload.upload_id, None)
+        send(session, {
+            "type": "upload_error",
+            "upload_id": upload.upload_id,
+            "message": str(e)
+        })
+        return
+    send(session, {
+        "type": "upload_ready",
+        "upload_id": upload.upload_id,
+        "offset": upload.received,
+        "chunk_size": CHUNK_SIZE
+    })
+    
+    # Empty files have nothing left to stream
+    if upload.done():
+        await finish_upload(session, upload, session.upload_rooms.pop(upload.upload_id, room))
+
+async def stream_download(session, download_id, info, offset):
+    """Send a stored file as binary chunks starting at offset"""
+    websocket = session.websocket
+    if not await store.acquire(session.username, SLOT_TIMEOUT):
+        send(session, {
+            "type": "system",
+            "message": "Too many transfers in progress, try the download again shortly."
+        })
+        return
+    if compression.incompressible(info.filename):
+        compression.send_raw(websocket, download_id)
+    try:
+        await websocket.send(session.codec.encode({
+            "type": "download_start",
+            "download_id": download_id,
+            "filename": info.filename,
+            "size": info.size,
+            "offset": offset
+        }))
+        
+        async for chunk_offset, chunk in content.read_chunks(info, offset, CHUNK_SIZE):
+            await asyncio.wait_for(websocket.send(pack_chunk(download_id, chunk_offset, chunk)), STALL_TIMEOUT)
+            bytes_downloaded.inc(amount=len(chunk))
+        
+        await websocket.send(session.codec.encode({
+            "type": "download_complete",
+            "download_id": download_id
+        }))
+    except asyncio.TimeoutError:
+        # The client stopped reading; nothing else will get through to it either
+        asyncio.create_task(websocket.close(1008, "Transfer stalled"))
+    finally:
+        compression.forget(websocket, download_id)
+        store.release(session.username)
 
 async def handle_connection(websocket):
     """Handle a client connection"""
     username = None
+    session = None  # set once logged in
+    codec = codecs.JSON
     
     try:
         # Authentication
-        auth_data = await websocket.recv()
-        auth = json.loads(auth_data)
+        auth_data = await asyncio.wait_for(websocket.recv(), AUTH_TIMEOUT)
+        auth_started = time.perf_counter()
+        auth = codecs.decode(auth_data)
         
         if auth.get("type") != "auth":
             await websocket.close()
             return
             
-        username = auth.get("username")
-        password = auth.get("password")
+        # Verify a session token (cheap) or the password (hashed on the auth pool)
+        token = auth.get("token")
+        if token:
+            username = await authenticator.resume(token)
+            verified = username is not None
+        else:
+            username = auth.get("username")
+            verified = await authenticator.login(username, auth.get("password"))
         
-        # Check if already logged in
-        if username in active_users:
-            await websocket.send(json.dumps({
-                "type": "system",
-                "message": "User already logged in from another location."
-            }))
-            await websocket.close()
-            return
-            
-        # Verify credentials
-        if username in USER_DB and USER_DB[username] == password:
-            # Login successful
-            active_users[username] = websocket
-            
-            # Notify all users
-            await broadcast({
-                "type": "system",
-                "message": f"{username} joined the chat."
-            })
+        if verified:
+            # Check if already logged in (on any worker)
+            if not await bus.claim(username):
+                await websocket.send(codecs.JSON.encode({
+                    "type": "system",
+                    "message": "User already logged in from another location."
+                }))
+                await websocket.close()
+                return
             
-            # Send user list to new client
-            await websocket.send(json.dumps({
-                "type": "users_list",
-                "users": list(active_users.keys())
+            # Login successful; tell the client which codec the rest of the session uses
+            codec = codecs.negotiate(auth.get("codecs"))
+            batch = bool(auth.get("batch")) and SEND_BATCH_WINDOW is not None
+            session = Session(username, websocket, broadcaster.add(websocket, codec, batch), codec)
+            await websocket.send(codecs.JSON.encode({
+                "type": "welcome",
+                "username": username,
+                "token": authenticator.issue(username),
+                "codec": codec.name,
+                "batch": batch
             }))
+            active_users[username] = session
+            auth_seconds.observe(time.perf_counter() - auth_started)
+            
+            # Everyone starts in the default room; a reconnecting client gets its
+            # rooms back plus whatever was sent while it was away
+            resume = auth.get("resume")
+            if isinstance(resume, dict):
+                await resume_session(session, resume)
+            else:
+                await join_room(session, DEFAULT_ROOM)
         else:
             # Login failed
-            await websocket.send(json.dumps({
+            await websocket.send(codecs.JSON.encode({
                 "type": "system",
-                "message": "Authentication failed."
+                "message": "Session expired." if token else "Authentication failed."
             }))
             await websocket.close()
             return
             
         # Message handling loop
         async for message_data in websocket:
-            message = json.loads(message_data)
-            msg_type = message.get("type")
-            
-            # Check rate limit for chat and file messages
-            if msg_type in ["chat", "file"]:
-                # Update timestamps
-                now = time.time()
-                timestamps = message_timestamps.get(username, [])
-                timestamps = [t for t in timestamps if now - t < WINDOW_SECONDS]
-                timestamps.append(now)
-                message_timestamps[username] = timestamps
-                
-                # Check if rate limited
-                if len(timestamps) > MAX_MESSAGES:
-                    await websocket.send(json.dumps({
-                        "type": "system",
-                        "message": "You are sending messages too quickly. Please wait."
-                    }))
+            started = time.perf_counter()
+            msg_type = "chunk"
+            try:
+                # Chunk frames carry streamed upload data
+                if is_chunk(message_data):
+                    # Throttle uploads by bytes rather than rejecting chunks
+                    messages_in.inc("chunk")
+                    bytes_uploaded.inc(amount=len(message_data))
+                    wait = limiter.delay(username, "upload_bytes", len(message_data))
+                    if wait:
+                        await asyncio.sleep(wait)
+                        started = time.perf_counter()  # don't count throttling as handler time
+                    
+                    try:
+                        upload = await uploads.write_chunk(username, message_data)
+                    except (TransferError, ValueError) as e:
+                        send(session, {
+                            "type": "upload_error",
+                            "message": str(e)
+                        })
+                        continue
+                    
+                    if upload.done():
+                        room = (session.upload_rooms or {}).pop(upload.upload_id, DEFAULT_ROOM)
+                        await finish_upload(session, upload, room)
+                    elif upload.should_report():
+                        send(session, {
+                            "type": "upload_progress",
+                            "upload_id": upload.upload_id,
+                            "received": upload.received,
+                            "size": upload.size
+                        })
                     continue
-            
-            # Handle message by type
-            if msg_type == "chat":
-                await broadcast({
-                    "type": "chat",
-                    "from": username,
-                    "message": message.get("message", "")
-                })
                 
-            elif msg_type == "file":
-                # Process file upload
-                filename = message.get("filename")
-                file_data_b64 = message.get("data")
+                message = codecs.decode(message_data)
+                msg_type = message.get("type")
+                if msg_type not in MESSAGE_TYPES:
+                    msg_type = "other"  # keeps metric labels and limiter keys to a known set
+                messages_in.inc(msg_type)
                 
-                # Decode file data
-                file_data = base64.b64decode(file_data_b64)
-                
-                # Check file size (10MB limit)
-                if len(file_data) > 10 * 1024 * 1024:
-                    await websocket.send(json.dumps({
+                if msg_type in ADMIN_TYPES and username not in ADMIN_USERS:
+                    send(session, {
                         "type": "system",
-                        "message": "File too large. Maximum size is 10MB."
-                    }))
+                        "message": "Server stats are only available to admins."
+                    })
                     continue
                 
-                # Save file
-                safe_filename = os.path.basename(filename)
-                file_id = f"{int(time.time())}_{safe_filename}"
-                file_path = os.path.join("uploads", file_id)
-                
-                with open(file_path, "wb") as f:
-                    f.write(file_data)
-                
-                # Notify all users
-                await broadcast({
-                    "type": "file_shared",
-                    "from": username,
-                    "filename": safe_filename,
-                    "file_id": file_id
-                })
-                
-            elif msg_type == "file_request":
-                # Process file download request
-                file_id = message.get("file_id")
-                
-                # Security check
-                if '..' in file_id or '/' in file_id:
-                    await websocket.send(json.dumps({
+                # Check rate limits for this message type
+                if not limiter.allow(username, msg_type):
+                    send(session, {
                         "type": "system",
-                        "message": "Invalid file ID."
-                    }))
+                        "message": "You are sending messages too quickly. Please wait."
+                    })
                     continue
                 
-                file_path = os.path.join("uploads", file_id)
-                
-                if not os.path.exists(file_path):
-                    await websocket.send(json.dumps({
+                if msg_type in BROADCAST_TYPES and not limiter.allow_global("broadcast"):
+                    send(session, {
                         "type": "system",
-                        "message": "File not found."
-                    }))
+                        "message": "Server is busy. Please try again shortly."
+                    })
                     continue
                 
-                # Read and send file
-                with open(file_path, "rb") as f:
-                    file_data = f.read()
+                # Messages posted to a room need the sender to be in it
+                room = message.get("room") or DEFAULT_ROOM
+                if msg_type in ROOM_TYPES and not valid_room(room):
+                    send(session, {
+                        "type": "system",
+                        "message": "Room names are 1-32 characters of a-z, 0-9, _ and -."
+                    })
+                    continue
                 
-                filename = file_id.split('_', 1)[1] if '_' in file_id else file_id
+                if msg_type in POST_TYPES and room not in session.rooms:
+                    send(session, {
+                        "type": "system",
+                        "message": f"You are not in #{room}."
+                    })
+                    continue
                 
-                await websocket.send(json.dumps({
-                    "type": "file_data",
-                    "filename": filename,
-                    "data": base64.b64encode(file_data).decode('utf-8')
-                }))
+                text = message.get("message", "")
+                if msg_type in TEXT_TYPES and (not isinstance(text, str) or len(text) > MAX_CHAT_CHARS):
+                    send(session, {
+                        "type": "system",
+                        "message": f"Messages can be at most {MAX_CHAT_CHARS} characters; use /file for longer text."
+                    })
+                    continue
                 
-            elif msg_type == "heartbeat":
-                # Respond to heartbeat
-                await websocket.send(json.dumps({
-                    "type": "heartbeat_ack",
-                    "timestamp": time.time()
-                }))
+                # Handle message by type
+                if msg_type == "chat":
+                    await broadcast({
+                        "type": "chat",
+                        "room": room,
+                        "from": username,
+                        "message": text
+                    }, room=room)
+                    
+                elif msg_type == "direct":
+                    # Private message to one user
+                    to = message.get("to")
+                    if to == username or not isinstance(to, str) or not await bus.is_online(to):
+                        send(session, {
+                            "type": "system",
+                            "message": f"{to} is not online."
+                        })
+                        continue
+                    
+                    direct = {
+                        "type": "direct",
+                        "from": username,
+                        "to": to,
+                        "message": text
+                    }
+                    # The sender's copy goes through the bus too, so it is numbered and replayable
+                    await send_direct(to, direct)
+                    await send_direct(username, direct)
+                    
+                elif msg_type == "join":
+                    if room in session.rooms:
+                        send(session, {
+                            "type": "system",
+                            "message": f"You are already in #{room}."
+                        })
+                    elif len(session.rooms) >= MAX_ROOMS_PER_USER:
+                        send(session, {
+                            "type": "system",
+                            "message": f"You can be in at most {MAX_ROOMS_PER_USER} rooms."
+                        })
+                    else:
+                        await join_room(session, room)
+                    
+                elif msg_type == "leave":
+                    if not rooms.leave(room, session):
+                        send(session, {
+                            "type": "system",
+                            "message": f"You are not in #{room}."
+                        })
+                        continue
+                    
+                    await bus.leave(username, room)
+                    send(session, {"type": "left", "room": room})
+                    presence.left(room, username)
+                    
+                elif msg_type == "rooms":
+                    # Every room with members, and the ones this user is in
+                    send(session, {
+                        "type": "rooms",
+                        "rooms": await bus.room_list(),
+                        "joined": sorted(session.rooms)
+                    })
+                    
+                elif msg_type == "users":
+                    # Members of one room
+                    send(session, {
+                        "type": "users_list",
+                        "room": room,
+                        "users": await bus.members(room)
+                    }, key=f"users_list:{room}")
+                    
+                elif msg_type == "file":
+                    # Legacy one-message upload; checked before the payload is decoded
+                    safe_filename = os.path.basename(message.get("filename") or "")
+                    file_data_b64 = message.get("data") or ""
+                    size = len(file_data_b64) * 3 // 4
+                    
+                    if not safe_filename or size > MAX_INLINE_FILE:
+                        send(session, {
+                            "type": "system",
+                            "message": f"Invalid or too large file. Files over {MAX_INLINE_FILE // 1024}KB must be streamed."
+                        })
+                        continue
+                    
+                    # Charge the decoded size against the upload byte limit
+                    if not limiter.allow(username, "upload_bytes", size):
+                        send(session, {
+                            "type": "system",
+                            "message": "You are uploading too quickly. Please wait."
+                        })
+                        continue
+                    
+                    # Then the same checks as a streamed upload
+                    name = os.path.join(PARTIAL_DIR, new_transfer_id())
+                    try:
+                        await uploads.check_quota(username, size)
+                        await store.save(name, base64.b64decode(file_data_b64))
+                        await uploads.verify(name, safe_filename)
+                    except (TransferError, ValueError) as e:
+                        await store.delete(name)
+                        send(session, {
+                            "type": "system",
+                            "message": str(e) if isinstance(e, TransferError) else "Invalid file data."
+                        })
+                        continue
+                    file_id = await content.add_file(name, safe_filename, username)
+                    
+                    # Notify the room
+                    await broadcast({
+                        "type": "file_shared",
+                        "room": room,
+                        "from": username,
+                        "filename": safe_filename,
+                        "file_id": file_id
+                    }, room=room)
+                    
+                elif msg_type == "file_request":
+                    # Process file download request
+                    file_id = message.get("file_id")
+                    
+                    # Ids are index keys, not paths; lookup is a parameterized query
+                    if not valid_file_id(file_id):
+                        send(session, {
+                            "type": "system",
+                            "message": "Invalid file ID."
+                        })
+                        continue
+                    
+                    info = await content.lookup(file_id)
+                    
+                    if info is None:
+                        send(session, {
+                            "type": "system",
+                            "message": "File not found."
+                        })
+                        continue
+                    
+                    # The whole file goes out base64-encoded in one frame, so only small ones
+                    if info.size > MAX_INLINE_FILE:
+                        send(session, {
+                            "type": "system",
+                            "message": f"File is over {MAX_INLINE_FILE // 1024}KB; use download_request to stream it."
+                        })
+                        continue
+                    
+                    # Send file; popular files come base64-encoded from the cache
+                    send(session, {
+                        "type": "file_data",
+                        "filename": info.filename,
+                        "data": await content.read_b64(info)
+                    })
+                    
+                elif msg_type == "upload_start":
+                    # Begin or resume a streamed upload
+                    upload_id = message.get("upload_id")
+                    try:
+                        upload = await uploads.start(
+                            username,
+                            upload_id,
+                            message.get("filename"),
+                            message.get("size"),
+                            message.get("sha256")
+                        )
+                    except TransferError as e:
+                        send(session, {
+                            "type": "upload_error",
+                            "upload_id": upload_id,
+                            "message": str(e)
+                        })
+                        continue
+                    
+                    if session.upload_rooms is None:
+                        session.upload_rooms = {}
+                    session.upload_rooms[upload.upload_id] = room
+                    track_transfer(session, asyncio.create_task(ready_upload(session, upload, room)))
+                    
+                elif msg_type == "download_request":
+                    # Stream a stored file back as binary chunks
+                    file_id = message.get("file_id")
+                    download_id = message.get("download_id")
+                    offset = message.get("offset", 0)
+                    
+                    if not valid_file_id(file_id) or not valid_transfer_id(download_id):
+                        send(session, {
+                            "type": "system",
+                            "message": "Invalid file ID."
+                        })
+                        continue
+                    
+                    info = await content.lookup(file_id)
+                    
+                    if info is None:
+                        send(session, {
+                            "type": "system",
+                            "message": "File not found."
+                        })
+                        continue
+                    
+                    if not isinstance(offset, int) or not 0 <= offset <= info.size:
+                        offset = 0
+                    
+                    track_transfer(session, asyncio.create_task(stream_download(session, download_id, info, offset)))
+                    
+                elif msg_type == "heartbeat":
+                    # Respond to heartbeat
+                    send(session, {
+                        "type": "heartbeat_ack",
+                        "timestamp": time.time()
+                    })
+                    
+                elif msg_type == "history_request":
+                    # Page of messages older than a sequence number
+                    before = message.get("before")
+                    limit = message.get("limit", JOIN_BACKFILL)
+                    if not isinstance(before, int) or not isinstance(limit, int):
+                        send(session, {
+                            "type": "system",
+                            "message": "Invalid history request."
+                        })
+                        continue
+                    
+                    messages, more = await history.page(before, limit, room)
+                    send(session, {
+                        "type": "history",
+                        "room": room,
+                        "messages": messages,
+                        "more": more
+                    })
+                    
+                elif msg_type == "rate_limit_stats":
+                    # Report how often each limit has fired
+                    send(session, {
+                        "type": "rate_limit_stats",
+                        "limits": limiter.stats()
+                    })
+                    
+                elif msg_type == "queue_stats":
+                    # Report outbound queue depth per user
+                    send(session, {
+                        "type": "queue_stats",
+                        "queues": queue_stats()
+                    })
+                    
+                elif msg_type == "metrics":
+                    # Full instrumentation snapshot, plus profiler samples if enabled
+                    send(session, {
+                        "type": "metrics",
+                        "pid": os.getpid(),
+                        "metrics": registry.snapshot(),
+                        "profile": profiler.top() if profiler else None
+                    })
+            finally:
+                elapsed = time.perf_counter() - started
+                handler_seconds.observe(elapsed)
+                if elapsed > SLOW_HANDLER_SECONDS:
+                    slow_handlers.inc(msg_type)
+                    print(f"Slow handler: {msg_type} from {username} took {elapsed * 1000:.0f}ms")
     
-    except websockets.exceptions.ConnectionClosed:
+    except (websockets.exceptions.ConnectionClosed, asyncio.TimeoutError):
         pass
     except Exception as e:
         print(f"Error: {e}")
     finally:
         # Cleanup on disconnect
-        if username and username in active_users:
-            del active_users[username]
+        if session:
+            for task in list(session.transfers or ()):
+                task.cancel()
             
-            if message_timestamps.get(username):
-                del message_timestamps[username]
+            await uploads.pause(username)
+            await bus.release(username)  # also drops them from every room
+            active_users.pop(username, None)
+            await broadcaster.remove(session.queue)
             
-            # Notify users about disconnect
-            await broadcast({
-                "type": "system",
-                "message": f"{username} left the chat."
-            })
+            limiter.forget(username)
+            
+            # Notify each room they were in
+            for room in rooms.leave_all(session):
+                presence.left(room, username)
+
+async def enforce_retention():
+    """Periodically expire old files and keep the upload store under its size cap"""
+    while True:
+        try:
+            await content.enforce_retention()
+        except Exception as e:
+            print(f"Retention error: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+async def evict_idle():
+    """Close connections that have sent nothing, not even a ping, for IDLE_TIMEOUT"""
+    while True:
+        await asyncio.sleep(IDLE_CHECK_INTERVAL)
+        now = time.monotonic()
+        for session in list(active_users.values()):
+            if session.idle_for(now) > IDLE_TIMEOUT:
+                idle_evictions.inc()
+                # A vanished client won't answer the close handshake; the
+                # close timeout then drops the connection
+                asyncio.create_task(session.websocket.close(1001, "Idle timeout"))
 
-async def main():
+async def release_stalled_uploads():
+    """Take slots back from uploads that stopped sending; they can resume later"""
+    while True:
+        await asyncio.sleep(IDLE_CHECK_INTERVAL)
+        for upload in await uploads.release_stalled(STALL_TIMEOUT):
+            session = active_users.get(upload.owner)
+            if session:
+                send(session, {
+                    "type": "upload_error",
+                    "upload_id": upload.upload_id,
+                    "message": "Upload stalled; send upload_start again to resume."
+                })
+
+def use_profile(name):
+    """Switch connection profile; call before serving"""
+    global profile, compression_policy
+    profile = PROFILES[name]
+    broadcaster.max_queue = profile["send_queue"]
+    compression_policy = compression.CompressionPolicy(context_takeover=profile["context_takeover"])
+    broadcaster.shared = compression_policy.share
+
+async def serve(reuse_port=False, metrics_port=METRICS_PORT):
     """Start the server"""
     # Set up SSL
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
@@ -217,20 +887,117 @@ async def main():
         print("Generate them with: openssl req -x509 -newkey rsa:4096 -keyout server.key -out server.crt -days 365 -nodes")
         return
     
+    await authenticator.start(DEFAULT_USERS)
+    
+    # Connect to the presence/fan-out bus
+    bus.subscribe(deliver)
+    await bus.start()
+    await history.start()
+    await content.start()
+    retention_task = asyncio.create_task(enforce_retention())
+    idle_task = asyncio.create_task(evict_idle())
+    stalled_task = asyncio.create_task(release_stalled_uploads())
+    
+    # asyncio gives every TLS connection its own read buffer, 256KB unless profile says otherwise
+    if profile["tls_read_buffer"] and hasattr(sslproto.SSLProtocol, "max_size"):
+        sslproto.SSLProtocol.max_size = profile["tls_read_buffer"]
+    
+    # Instrumentation
+    lag_task = asyncio.create_task(metrics.watch_loop_lag(loop_lag))
+    if metrics_port:
+        await metrics.serve_http(registry, METRICS_HOST, metrics_port)
+        print(f"Metrics at http://{METRICS_HOST}:{metrics_port}/metrics")
+    if profiler:
+        profiler.start()
+    
     # Start server
     server = await websockets.serve(
         handle_connection,
         "localhost",
         8765,
         ssl=ssl_context,
-        ping_interval=30,
-        ping_timeout=10
+        create_connection=Connection,  # tracks last activity for evict_idle
+        ping_interval=None,  # clients ping; see IDLE_TIMEOUT
+        max_size=profile["max_size"],
+        max_queue=profile["max_queue"],
+        write_limit=profile["write_limit"],
+        compression=None,  # replaced by compression_policy's extension
+        extensions=compression_policy.server_extensions(),
+        reuse_port=reuse_port
     )
     
-    print("Chat server running at wss://localhost:8765")
+    print(f"Chat server running at wss://localhost:8765 (pid {os.getpid()})")
     
     # Keep server running
     await server.wait_closed()
 
+def run_worker(index):
+    """Worker process entry point: serve on the shared port via the broker bus"""
+    global bus
+    bus = SocketBus(BUS_HOST, BUS_PORT)
+    try:
+        asyncio.run(serve(True, METRICS_PORT + index if METRICS_PORT else None))
+    except KeyboardInterrupt:
+        pass
+
+def run_bus_broker(ready):
+    """Broker process entry point"""
+    try:
+        asyncio.run(run_broker(BUS_HOST, BUS_PORT, ready))
+    except KeyboardInterrupt:
+        pass
+
+def main(workers=WORKERS):
+    """Run one server process, or a broker plus several workers"""
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT not available on this platform, running a single worker.")
+        workers = 1
+    
+    if workers <= 1:
+        asyncio.run(serve())
+        return
+    
+    # Start the broker first so workers can connect to it
+    ready = multiprocessing.Event()
+    broker = multiprocessing.Process(target=run_bus_broker, args=(ready,), daemon=True)
+    broker.start()
+    if not ready.wait(10):
+        print(f"Message bus failed to start on {BUS_HOST}:{BUS_PORT}.")
+        broker.terminate()
+        return
+    
+    processes = [multiprocessing.Process(target=run_worker, args=(i,)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    
+    # Treat SIGTERM like Ctrl+C so workers aren't left running
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        broker.terminate()
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Team chat server")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="number of server processes")
+    parser.add_argument("--bench-users", type=int, default=0, help="add bench0..benchN-1 accounts (password 'bench') for bench.py")
+    parser.add_argument("--dense", action="store_true", help="connection profile for many mostly idle users")
+    parser.add_argument("--scan-command", help="scanner run on each finished upload, e.g. \"clamdscan --no-summary\"; non-zero exit rejects it")
+    args = parser.parse_args()
+    
+    if args.dense:
+        use_profile("dense")
+    if args.scan_command:
+        postprocessor.add(command_hook(args.scan_command))
+    
+    # Synthetic accounts for load testing
+    if args.bench_users:
+        authenticator.add_memory_users([f"bench{i}" for i in range(args.bench_users)], "bench", BENCH_SCRYPT_N)
+    
+    main(args.workers)
\ No newline at end of file
@@ -0,0 +1,42 @@
+import time
+from websockets.asyncio.server import ServerConnection
+
+
+class Session:
+    """What the server keeps for one logged-in connection
+
+    One object with fixed slots rather than an entry in a dict per kind of
+    state; with many idle users the per-user overhead is most of what a
+    connection costs once its buffers are small.
+    """
+
+    __slots__ = ("username", "websocket", "queue", "codec", "rooms", "transfers", "upload_rooms")
+
+    def __init__(self, username, websocket, queue, codec):
+        self.username = username
+        self.websocket = websocket
+        self.queue = queue  # broadcast.ClientQueue
+        self.codec = codec
+        self.rooms = set()  # rooms joined, maintained by RoomIndex
+        self.transfers = None  # running download and upload-slot tasks, made on first transfer
+        self.upload_rooms = None  # upload_id -> room the finished file is announced in, made on first upload
+
+    def idle_for(self, now):
+        """Seconds since the client last sent anything"""
+        return now - self.websocket.last_active
+
+
+class Connection(ServerConnection):
+    """ServerConnection that notes when the client last sent anything, pings included
+
+    Client pings are the heartbeat: the server doesn't ping, it closes
+    connections that have been silent for too long.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_active = time.monotonic()
+
+    def data_received(self, data):
+        self.last_active = time.monotonic()
+        super().data_received(data)
@@ -0,0 +1,232 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Storage modes
+THREADED = "threaded"  # file I/O runs on a bounded thread pool
+INLINE = "inline"      # file I/O runs directly on the event loop (old behaviour)
+
+MODES = (THREADED, INLINE)
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class AsyncFile:
+    """File handle whose blocking calls go through a FileStore"""
+
+    def __init__(self, store, f):
+        self.store = store
+        self.f = f
+
+    async def read(self, size=-1):
+        return await self.store.run(self.f.read, size)
+
+    async def write(self, data):
+        return await self.store.run(self.f.write, data)
+
+    async def seek(self, offset):
+        return await self.store.run(self.f.seek, offset)
+
+    async def truncate(self):
+        return await self.store.run(self.f.truncate)
+
+    async def close(self):
+        await self.store.run(self.f.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class BackgroundWriter:
+    """Writes chunks to an AsyncFile from its own task, so the caller doesn't wait on the disk
+
+    Up to max_pending chunks are queued; past that put() waits, slowing the
+    caller to disk speed rather than buffering without limit.
+    """
+
+    def __init__(self, f, max_pending=64):
+        self.f = f
+        self.queue = asyncio.Queue(max_pending)
+        self.written = 0
+        self.error = None
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            data = await self.queue.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    await self.f.write(data)
+                    self.written += len(data)
+                except OSError as e:
+                    self.error = e  # keep draining so put() never blocks for good
+
+    async def put(self, data):
+        await self.queue.put(data)
+
+    async def close(self):
+        """Finish the queued writes, then close the file; raises the first write error"""
+        await self.queue.put(None)
+        await self.task
+        await self.f.close()
+        if self.error:
+            raise self.error
+
+
+class FileStore:
+    """Async save/open/stat/delete for files under one directory"""
+
+    def __init__(self, root, mode=THREADED, workers=4, max_transfers=16, max_per_owner=4):
+        if mode not in MODES:
+            raise ValueError(f"Unknown storage mode: {mode}")
+        self.root = root
+        self.mode = mode
+        self.executor = ThreadPoolExecutor(workers, "filestore") if mode == THREADED else None
+        self.max_transfers = max_transfers
+        self.max_per_owner = max_per_owner
+        self.transfers = 0
+        self.owners = {}  # owner -> slots held or being waited for
+        self.slots = None  # created lazily so it binds to the running loop
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    async def run(self, func, *args):
+        """Run a blocking call according to the storage mode"""
+        if self.executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    # Transfer slots: callers wait here when too many transfers are active.
+    # One owner can hold or wait for at most max_per_owner of them, so a single
+    # user can't take every slot.
+    async def acquire(self, owner=None, timeout=None):
+        """Take a slot; False if owner is at their limit or none frees up within timeout"""
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_transfers)
+        if owner is not None:
+            if self.owners.get(owner, 0) >= self.max_per_owner:
+                return False
+            self.owners[owner] = self.owners.get(owner, 0) + 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self._forget(owner)
+            return False
+        except BaseException:
+            self._forget(owner)
+            raise
+        self.transfers += 1
+        return True
+
+    def release(self, owner=None):
+        self.transfers -= 1
+        self.slots.release()
+        self._forget(owner)
+
+    def _forget(self, owner):
+        if owner is None:
+            return
+        self.owners[owner] -= 1
+        if not self.owners[owner]:
+            del self.owners[owner]
+
+    async def open(self, name, mode="rb"):
+        f = await self.run(open, self.path(name), mode)
+        return AsyncFile(self, f)
+
+    async def save(self, name, data):
+        """Write a whole file"""
+        def write():
+            with open(self.path(name), "wb") as f:
+                f.write(data)
+        await self.run(write)
+
+    async def read(self, name):
+        """Read a whole file"""
+        def read():
+            with open(self.path(name), "rb") as f:
+                return f.read()
+        return await self.run(read)
+
+    async def read_chunks(self, name, offset=0, chunk_size=READ_CHUNK_SIZE):
+        """Yield (offset, chunk) pairs from a file starting at offset"""
+        async with await self.open(name) as f:
+            await f.seek(offset)
+            while True:
+                data = await f.read(chunk_size)
+                if not data:
+                    break
+                yield offset, data
+                offset += len(data)
+
+    async def stat(self, name):
+        """os.stat result for a regular file, or None if there isn't one"""
+        def stat():
+            try:
+                st = os.stat(self.path(name))
+            except (FileNotFoundError, NotADirectoryError):
+                return None
+            return st if os.path.isfile(self.path(name)) else None
+        return await self.run(stat)
+
+    async def delete(self, name):
+        """Remove a file, ignoring ones that are already gone"""
+        def delete():
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+        await self.run(delete)
+
+    async def replace(self, src, dst):
+        """Atomically rename src to dst within the store"""
+        await self.run(os.replace, self.path(src), self.path(dst))
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+
+async def benchmark(mode, count=20, size=8 * 1024 * 1024):
+    """Save and read back files while measuring how late a 1ms ticker runs"""
+    store = FileStore(os.path.join("bench_storage", mode), mode)
+    data = os.urandom(size)
+    lags = []
+    stop = asyncio.Event()
+
+    async def ticker():
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            start = loop.time()
+            await asyncio.sleep(0.001)
+            lags.append(loop.time() - start - 0.001)
+
+    tick = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(store.save(f"{i}.bin", data) for i in range(count)))
+    await asyncio.gather(*(store.read(f"{i}.bin") for i in range(count)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await tick
+
+    for i in range(count):
+        await store.delete(f"{i}.bin")
+    store.close()
+    os.rmdir(store.root)
+
+    lags.sort()
+    print(f"{mode:>8}: {elapsed:.2f}s total, "
+          f"max loop lag {lags[-1] * 1000:.1f}ms, "
+          f"p99 loop lag {lags[int(len(lags) * 0.99)] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    for mode in MODES:
+        asyncio.run(benchmark(mode))
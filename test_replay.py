@@ -0,0 +1,102 @@
+import unittest
+
+from replay import EVERYONE, ReplayLog
+
+
+def seqs(events):
+    return [event["event_seq"] for event in events]
+
+
+class ReplayLogTest(unittest.TestCase):
+    def setUp(self):
+        self.log = ReplayLog(room_events=3, user_events=2, max_rings=10)
+        self.start = self.log.seq
+
+    def test_merges_rings_in_seq_order(self):
+        a = self.log.record({"type": "chat"}, room="general")
+        b = self.log.record({"type": "users_diff"})
+        c = self.log.record({"type": "direct"}, user="joe")
+        self.log.record({"type": "direct"}, user="bob")
+        d = self.log.record({"type": "chat"}, room="dev")
+        self.log.record({"type": "chat"}, room="random")
+
+        events, missed = self.log.since("joe", ["general", "dev"], self.start)
+        self.assertEqual(seqs(events), [a["event_seq"], b["event_seq"], c["event_seq"], d["event_seq"]])
+        self.assertEqual(missed, [])
+
+    def test_only_events_after_seq(self):
+        first = self.log.record({"type": "chat"}, room="general")
+        second = self.log.record({"type": "chat"}, room="general")
+        events, missed = self.log.since("joe", ["general"], first["event_seq"])
+        self.assertEqual(seqs(events), [second["event_seq"]])
+        self.assertEqual(missed, [])
+        self.assertEqual(self.log.since("joe", ["general"], second["event_seq"]), ([], []))
+
+    def test_full_ring_raises_floor(self):
+        sent = [self.log.record({"type": "chat"}, room="general") for _ in range(5)]
+        ring = self.log.rings["general"]
+        self.assertEqual(ring.floor, sent[1]["event_seq"])
+
+        # Still in the ring: replayed
+        events, missed = self.log.since("joe", ["general"], sent[1]["event_seq"])
+        self.assertEqual(seqs(events), seqs(sent[2:]))
+        self.assertEqual(missed, [])
+
+        # Older than the ring: missed, and none of its events replayed
+        events, missed = self.log.since("joe", ["general"], sent[0]["event_seq"])
+        self.assertEqual(events, [])
+        self.assertEqual(missed, ["general"])
+
+    def test_ring_byte_budget_raises_floor(self):
+        log = ReplayLog(room_events=100, room_bytes=3000)
+        sent = [log.record({"type": "chat", "message": "x" * 1000}, room="general") for _ in range(5)]
+        ring = log.rings["general"]
+        self.assertLessEqual(ring.bytes, 3000)
+        self.assertEqual(ring.floor, sent[2]["event_seq"])
+
+        events, missed = log.since("joe", ["general"], sent[2]["event_seq"])
+        self.assertEqual(seqs(events), seqs(sent[3:]))
+        self.assertEqual(missed, [])
+        self.assertEqual(log.since("joe", ["general"], sent[1]["event_seq"]), ([], ["general"]))
+
+    def test_oversized_event_still_kept(self):
+        log = ReplayLog(room_bytes=100)
+        log.record({"type": "chat", "message": "x" * 1000}, room="general")
+        last = log.record({"type": "chat", "message": "y" * 1000}, room="general")
+        self.assertEqual(seqs(log.since("joe", ["general"], last["event_seq"] - 1)[0]), [last["event_seq"]])
+
+    def test_missed_room_leaves_other_rings_replayed(self):
+        early = self.log.record({"type": "direct"}, user="joe")
+        for _ in range(4):
+            self.log.record({"type": "chat"}, room="general")
+        dev = self.log.record({"type": "chat"}, room="dev")
+
+        events, missed = self.log.since("joe", ["general", "dev"], self.start)
+        self.assertEqual(missed, ["general"])
+        self.assertEqual(seqs(events), [early["event_seq"], dev["event_seq"]])
+
+    def test_dropped_ring_raises_log_floor(self):
+        self.log.max_rings = 4
+        old = self.log.record({"type": "chat"}, room="a")
+        for room in ["b", "c", "d", "e"]:  # one more than max_rings
+            self.log.record({"type": "chat"}, room=room)
+        self.assertNotIn("a", self.log.rings)
+        self.assertEqual(self.log.floor, old["event_seq"])
+
+        # A room with no ring can't be replayed from before the log floor
+        _, missed = self.log.since("joe", ["a"], self.start)
+        self.assertEqual(missed, ["a"])
+        self.assertEqual(self.log.since("joe", ["a"], old["event_seq"]), ([], []))
+
+    def test_everyone_and_user_rings_never_missed(self):
+        for _ in range(5):
+            self.log.record({"type": "users_diff"})
+            self.log.record({"type": "direct"}, user="joe")
+        events, missed = self.log.since("joe", [], self.start)
+        self.assertEqual(missed, [])
+        self.assertEqual(len(events), 3 + 2)
+        self.assertIn(EVERYONE, self.log.rings)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,278 @@
+import hashlib
+import os
+import struct
+import time
+import uuid
+
+# Binary frame layout: 1-byte frame kind, 16-byte transfer id, 8-byte offset, then chunk bytes
+HEADER = struct.Struct("!B16sQ")
+CHUNK_FRAME = 0x01
+CHUNK_SIZE = 64 * 1024
+MAX_FILE_SIZE = 1024 * 1024 * 1024  # 1GB for streamed transfers
+PROGRESS_EVERY = 1024 * 1024  # send upload_progress every 1MB
+PARTIAL_TTL = 60 * 60  # keep unfinished uploads around for resume this long
+PARTIAL_DIR = ".partial"  # unfinished uploads, inside the upload store
+USER_QUOTA = 2 * 1024 * 1024 * 1024  # stored plus in-progress upload bytes per user
+HASH_BLOCK = 1024 * 1024
+
+
+def new_transfer_id():
+    """Random hex id for an upload or download"""
+    return uuid.uuid4().hex
+
+
+def pack_chunk(transfer_id, offset, data):
+    """Build a binary frame for one chunk"""
+    return HEADER.pack(CHUNK_FRAME, bytes.fromhex(transfer_id), offset) + data
+
+
+def is_chunk(frame):
+    """True for a binary frame carrying file data"""
+    return isinstance(frame, bytes) and frame[:1] == b"\x01"
+
+
+def unpack_chunk(frame):
+    """Split a binary frame into (transfer_id, offset, data)"""
+    if len(frame) < HEADER.size:
+        raise ValueError("Chunk frame too short")
+    kind, raw_id, offset = HEADER.unpack_from(frame)
+    if kind != CHUNK_FRAME:
+        raise ValueError("Not a chunk frame")
+    return raw_id.hex(), offset, memoryview(frame)[HEADER.size:]
+
+
+def valid_sha256(digest):
+    """True for a 64 character lowercase hex SHA-256"""
+    return isinstance(digest, str) and len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+
+def hash_file(path):
+    """SHA-256 hex digest of a file, read in blocks"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def valid_transfer_id(transfer_id):
+    """True for a 32 character hex id"""
+    try:
+        return len(bytes.fromhex(transfer_id)) == 16
+    except (TypeError, ValueError):
+        return False
+
+
+class TransferError(Exception):
+    """Raised when a chunk or transfer request can't be accepted"""
+
+
+class Upload:
+    """One in-progress upload, written straight to a partial file"""
+
+    def __init__(self, upload_id, owner, filename, size, name, received=0, sha256=None):
+        self.upload_id = upload_id
+        self.owner = owner
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256  # declared by the client, checked once all bytes are in
+        self.name = name  # partial file name within the store
+        self.received = received
+        self.reported = received
+        self.updated = time.monotonic()
+        self.file = None
+        self.has_slot = False
+        # Hash as chunks arrive; not possible when resuming data written by an earlier process
+        self.hasher = hashlib.sha256() if received == 0 else None
+
+    async def write(self, store, offset, data):
+        """Append a chunk; offsets must arrive in order"""
+        if offset != self.received:
+            raise TransferError(f"Expected offset {self.received}, got {offset}")
+        if self.received + len(data) > self.size:
+            raise TransferError("Chunk goes past declared file size")
+        if self.file is None:
+            self.file = await store.open(self.name, "ab")
+        await self.file.write(data)
+        if self.hasher:
+            self.hasher.update(data)
+        self.received += len(data)
+        self.updated = time.monotonic()
+
+    def done(self):
+        return self.received == self.size
+
+    def should_report(self):
+        """True once another PROGRESS_EVERY bytes have arrived"""
+        if self.received - self.reported >= PROGRESS_EVERY:
+            self.reported = self.received
+            return True
+        return False
+
+    async def close(self):
+        if self.file:
+            await self.file.close()
+            self.file = None
+
+
+class UploadManager:
+    """Streamed uploads from declaration to a verified file ready to be shared
+
+    An upload is declared (name, size, optionally its SHA-256) and accepted or
+    rejected before any data is read: size limit, then the owner's quota. Its
+    chunks go straight to a partial file and into a running hash. Once
+    complete the hash is checked against the declared one and the
+    postprocess hooks run; only then does the caller move the file into
+    place. Unfinished uploads can be resumed from their last offset.
+    """
+
+    def __init__(self, store, usage=None, quota=USER_QUOTA, postprocess=None):
+        self.store = store
+        self.usage = usage  # async usage(owner) -> bytes already stored for them
+        self.quota = quota
+        self.postprocess = postprocess  # postprocess.PostProcessor, or None
+        os.makedirs(store.path(PARTIAL_DIR), exist_ok=True)
+        self.uploads = {}  # upload_id -> Upload
+
+    def reserved(self, owner):
+        """Declared bytes of owner's uploads in progress on this process"""
+        return sum(upload.size for upload in self.uploads.values() if upload.owner == owner)
+
+    async def check_quota(self, owner, size):
+        """Raise TransferError if storing size more bytes would put owner over quota"""
+        if self.quota is None:
+            return
+        used = (await self.usage(owner) if self.usage else 0) + self.reserved(owner)
+        if used + size > self.quota:
+            mb = 1024 * 1024
+            raise TransferError(f"Upload quota exceeded: {used // mb}MB of {self.quota // mb}MB in use.")
+
+    async def start(self, owner, upload_id, filename, size, sha256=None):
+        """Begin a new upload or resume an unfinished one"""
+        await self.prune()
+
+        if not valid_transfer_id(upload_id):
+            raise TransferError("Invalid upload ID.")
+        if not isinstance(size, int) or size < 0:
+            raise TransferError("Invalid file size.")
+        if size > MAX_FILE_SIZE:
+            raise TransferError(f"File too large. Maximum size is {MAX_FILE_SIZE // (1024 * 1024)}MB.")
+        if sha256 is not None and not valid_sha256(sha256):
+            raise TransferError("Invalid SHA-256.")
+
+        safe_filename = os.path.basename(filename or "")
+        if not safe_filename:
+            raise TransferError("Invalid filename.")
+
+        upload = self.uploads.get(upload_id)
+        if upload:
+            if upload.owner != owner or upload.size != size or upload.sha256 != sha256:
+                raise TransferError("Upload ID already in use.")
+        else:
+            await self.check_quota(owner, size)
+            name = os.path.join(PARTIAL_DIR, upload_id)
+            st = await self.store.stat(name)
+            upload = Upload(upload_id, owner, safe_filename, size, name, st.st_size if st else 0, sha256)
+            self.uploads[upload_id] = upload
+
+        return upload
+
+    async def reserve(self, upload, timeout=None):
+        """Take a transfer slot for upload; chunks are only accepted while it holds one"""
+        if upload.has_slot:
+            return
+        if not await self.store.acquire(upload.owner, timeout):
+            raise TransferError("Too many transfers in progress, try again shortly.")
+        if upload.has_slot or self.uploads.get(upload.upload_id) is not upload:
+            # A second upload_start got there first, or the upload was dropped meanwhile
+            self.store.release(upload.owner)
+            return
+        upload.has_slot = True
+        upload.updated = time.monotonic()
+
+    async def write_chunk(self, owner, frame):
+        """Apply a binary chunk frame and return its upload"""
+        upload_id, offset, data = unpack_chunk(frame)
+        upload = self.uploads.get(upload_id)
+        if upload is None or upload.owner != owner:
+            raise TransferError("Unknown upload.")
+        if not upload.has_slot:
+            raise TransferError("Upload paused; send upload_start again to resume.")
+        await upload.write(self.store, offset, data)
+        return upload
+
+    async def finish(self, upload):
+        """Close a completed upload, verify it and return its SHA-256
+
+        Raises TransferError, with the partial file deleted, if it doesn't
+        match the declared hash or a postprocess hook rejects it.
+        """
+        if upload.file is None and upload.size == 0 and not await self.store.stat(upload.name):
+            # An empty file gets no chunks, so nothing has created its partial file yet
+            upload.file = await self.store.open(upload.name, "ab")
+        await self._release(upload)
+        del self.uploads[upload.upload_id]
+        if upload.hasher:
+            sha256 = upload.hasher.hexdigest()
+        else:
+            # Resumed from data an earlier process wrote
+            sha256 = await self.store.run(hash_file, self.store.path(upload.name))
+        if upload.sha256 and sha256 != upload.sha256:
+            await self.store.delete(upload.name)
+            raise TransferError("Checksum mismatch; upload discarded.")
+        await self.verify(upload.name, upload.filename)
+        return sha256
+
+    async def verify(self, name, filename):
+        """Run the postprocess hooks on a file in the store, deleting it if one rejects it"""
+        if self.postprocess is None:
+            return
+        reason = await self.postprocess.check(self.store.path(name), filename)
+        if reason:
+            await self.store.delete(name)
+            raise TransferError(reason)
+
+    async def pause(self, owner):
+        """Close file handles for a disconnected user, keeping partial data"""
+        for upload in list(self.uploads.values()):
+            if upload.owner == owner:
+                await self._release(upload)
+
+    async def release_stalled(self, timeout):
+        """Give back the slots of uploads that have received nothing for timeout seconds
+
+        Their partial data is kept, so they can resume with another upload_start.
+        Returns the uploads paused.
+        """
+        cutoff = time.monotonic() - timeout
+        stalled = [u for u in self.uploads.values() if u.has_slot and u.updated < cutoff]
+        for upload in stalled:
+            await self._release(upload)
+        return stalled
+
+    async def prune(self):
+        """Drop uploads that haven't been resumed within PARTIAL_TTL"""
+        cutoff = time.monotonic() - PARTIAL_TTL
+        for upload_id in [k for k, u in self.uploads.items() if u.updated < cutoff]:
+            upload = self.uploads.pop(upload_id)
+            await self._release(upload)
+            await self.store.delete(upload.name)
+
+    async def _release(self, upload):
+        """Close the partial file and give back the transfer slot"""
+        await upload.close()
+        if upload.has_slot:
+            upload.has_slot = False
+            self.store.release(upload.owner)
+
+
+def iter_chunks(path, offset=0):
+    """Yield (offset, chunk) pairs from a file starting at offset"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield offset, data
+            offset += len(data)
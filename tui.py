@@ -0,0 +1,322 @@
+import asyncio
+import codecs as text_codecs
+import collections
+import os
+import shutil
+import signal
+import sys
+
+SCROLLBACK_LINES = 2000  # lines kept for scrolling back; older ones are dropped
+MAX_FPS = 20  # redraws per second at most, however fast messages arrive
+EXIT_LINES = 5  # last lines of the pane printed to the normal screen on exit
+SCRIPT_WAIT_TIMEOUT = 30  # seconds a "!wait" in a script waits before giving up
+
+try:
+    import termios
+    import tty
+except ImportError:  # Windows: no split pane, LineUI is used instead
+    termios = None
+
+# Keys and escape sequences TerminalUI understands
+ENTER = ("\r", "\n")
+BACKSPACE = ("\x7f", "\x08")
+CLEAR_LINE = "\x15"  # Ctrl+U
+REDRAW = "\x0c"  # Ctrl+L
+PAGE_UP = "\x1b[5~"
+PAGE_DOWN = "\x1b[6~"
+
+
+class Scrollback:
+    """Ring buffer of output lines, newest last"""
+
+    def __init__(self, size=SCROLLBACK_LINES):
+        self.lines = collections.deque(maxlen=size)
+
+    def add(self, text):
+        """Append text, one entry per line; returns how many lines were added"""
+        lines = str(text).split("\n")
+        self.lines.extend(lines)
+        return len(lines)
+
+    def window(self, rows, cols, back=0):
+        """Screen rows for a pane rows high and cols wide, ending back lines before the newest
+
+        Long lines wrap, so only as many lines as can fill the pane are looked at.
+        """
+        out = []
+        end = len(self.lines) - back
+        for i in range(end - 1, -1, -1):
+            line = self.lines[i]
+            wrapped = [line[j:j + cols] for j in range(0, len(line), cols)] or [""]
+            out[:0] = wrapped
+            if len(out) >= rows:
+                return out[-rows:]
+        return out
+
+    def clear(self):
+        self.lines.clear()
+
+    def __len__(self):
+        return len(self.lines)
+
+
+def supported():
+    """True when stdin and stdout are a terminal TerminalUI can drive"""
+    return termios is not None and sys.stdin.isatty() and sys.stdout.isatty()
+
+
+class TerminalUI:
+    """Message pane above a status line and an input line
+
+    Output goes into the scrollback and marks the screen dirty; a render task
+    redraws at most MAX_FPS times a second, so a busy room costs one screen
+    write per frame rather than one per message, and incoming text never
+    lands in the middle of what's being typed. Keys are read without
+    blocking from the event loop. PageUp/PageDown scroll, Ctrl+U clears the
+    input line and Ctrl+L redraws.
+    """
+
+    def __init__(self, scrollback=SCROLLBACK_LINES, fps=MAX_FPS, out=sys.stdout):
+        self.scrollback = Scrollback(scrollback)
+        self.interval = 1 / fps
+        self.out = out
+        self.fd = sys.stdin.fileno()
+        self.decoder = text_codecs.getincrementaldecoder("utf-8")("replace")
+        self.typed = []  # characters on the input line
+        self.escape = ""  # escape sequence being read from the keyboard
+        self.back = 0  # lines scrolled back from the newest
+        self.status_text = ""
+        self.entered = asyncio.Queue()
+        self.dirty = asyncio.Event()
+        self.saved_mode = None
+        self.task = None
+        self.frames = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.saved_mode = termios.tcgetattr(self.fd)
+        tty.setcbreak(self.fd)  # keys arrive one at a time, unechoed; Ctrl+C still signals
+        loop.add_reader(self.fd, self._on_input)
+        try:
+            loop.add_signal_handler(signal.SIGWINCH, self.dirty.set)
+        except (AttributeError, NotImplementedError, RuntimeError):
+            pass
+        self.out.write("\x1b[?1049h")  # alternate screen; the shell's is restored on exit
+        self.dirty.set()
+        self.task = asyncio.create_task(self._render_loop())
+
+    def stop(self):
+        """Restore the terminal, then print the last few lines so the reason for exiting stays visible"""
+        if self.saved_mode is not None:
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.fd)
+            try:
+                loop.remove_signal_handler(signal.SIGWINCH)
+            except (AttributeError, NotImplementedError, RuntimeError):
+                pass
+            if self.task:
+                self.task.cancel()
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved_mode)
+            self.saved_mode = None
+            self.out.write("\x1b[?25h\x1b[?1049l")
+        tail = list(self.scrollback.lines)[-EXIT_LINES:]
+        self.scrollback.clear()
+        for line in tail:
+            self.out.write(f"{line}\n")
+        self.out.flush()
+
+    # Output
+
+    def write(self, text):
+        added = self.scrollback.add(text)
+        if self.back:
+            # Keep a scrolled-back view where it is
+            self.back = min(self.back + added, len(self.scrollback) - 1)
+        self.dirty.set()
+
+    def status(self, text):
+        self.status_text = text
+        self.dirty.set()
+
+    def clear(self):
+        self.scrollback.clear()
+        self.back = 0
+        self.dirty.set()
+
+    async def _render_loop(self):
+        while True:
+            await self.dirty.wait()
+            self.dirty.clear()
+            self.render()
+            await asyncio.sleep(self.interval)
+
+    def render(self):
+        """Redraw the whole screen with one write"""
+        cols, rows = shutil.get_terminal_size()
+        pane = max(1, rows - 2)
+        lines = self.scrollback.window(pane, cols, self.back)
+        screen = ["\x1b[?25l\x1b[H"]  # hide the cursor while drawing
+        screen.extend(f"{line}\x1b[K\r\n" for line in [""] * (pane - len(lines)) + lines)
+
+        status = self.status_text
+        if self.back:
+            status += f" | scrolled back {self.back} lines (PgDn)"
+        screen.append(f"\x1b[7m{status[:cols].ljust(cols)}\x1b[0m\r\n")
+
+        # Input line, showing the end of long input
+        typed = "".join(self.typed)[-(cols - 3):]
+        screen.append(f"> {typed}\x1b[K\x1b[?25h")
+        self.out.write("".join(screen))
+        self.out.flush()
+        self.frames += 1
+
+    # Input
+
+    async def read_line(self):
+        return await self.entered.get()
+
+    def _on_input(self):
+        try:
+            data = os.read(self.fd, 1024)
+        except OSError:
+            return
+        if not data:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            self.entered.put_nowait("/exit")
+            return
+        for char in self.decoder.decode(data):
+            self._key(char)
+        self.dirty.set()
+
+    def _key(self, char):
+        if self.escape or char == "\x1b":
+            self.escape += char
+            # CSI sequences end with a byte in @..~; anything else ends after one more character
+            if len(self.escape) > 2 and "@" <= char <= "~" or len(self.escape) == 2 and char != "[":
+                self._escape(self.escape)
+                self.escape = ""
+            return
+        if char in ENTER:
+            line = "".join(self.typed)
+            self.typed.clear()
+            self.back = 0
+            if line.strip():
+                self.entered.put_nowait(line)
+        elif char in BACKSPACE:
+            if self.typed:
+                self.typed.pop()
+        elif char == CLEAR_LINE:
+            self.typed.clear()
+        elif char == REDRAW:
+            self.out.write("\x1b[2J")
+        elif char >= " ":
+            self.typed.append(char)
+
+    def _escape(self, sequence):
+        page = max(1, shutil.get_terminal_size().lines - 3)
+        if sequence == PAGE_UP:
+            self.back = min(self.back + page, max(0, len(self.scrollback) - 1))
+        elif sequence == PAGE_DOWN:
+            self.back = max(0, self.back - page)
+
+
+class LineUI:
+    """Plain print and input(), for consoles the split pane can't drive"""
+
+    async def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def write(self, text):
+        print(text, flush=True)
+
+    def status(self, text):
+        pass
+
+    def clear(self):
+        os.system('cls' if os.name == 'nt' else 'clear')
+
+    async def read_line(self):
+        return await asyncio.get_running_loop().run_in_executor(None, input, "> ")
+
+
+class ScriptUI:
+    """Headless: commands come from a script and output goes to stdout, prefixed with label
+
+    Script lines are handled exactly as if typed. "!sleep <seconds>" pauses
+    and "!wait <text>" pauses until a line containing text is received (or
+    SCRIPT_WAIT_TIMEOUT passes). Blank lines and lines starting with "#" are
+    skipped. The session exits at the end of the script.
+    """
+
+    def __init__(self, lines=None, label="", out=sys.stdout):
+        self.lines = iter(lines) if lines is not None else None  # None streams stdin
+        self.label = f"[{label}] " if label else ""
+        self.out = out
+        self.recent = collections.deque(maxlen=SCROLLBACK_LINES)  # output since the last command, for !wait
+        self.waiting = None  # (text, future) while a !wait is pending
+
+    async def start(self):
+        pass
+
+    def stop(self):
+        self.out.flush()
+
+    def write(self, text):
+        for line in str(text).split("\n"):
+            self.out.write(f"{self.label}{line}\n")
+            self.recent.append(line)
+            if self.waiting and self.waiting[0] in line and not self.waiting[1].done():
+                self.waiting[1].set_result(line)
+
+    def status(self, text):
+        pass
+
+    def clear(self):
+        pass
+
+    async def _next(self):
+        if self.lines is None:
+            line = await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+            return line if line else None
+        return next(self.lines, None)
+
+    async def read_line(self):
+        while True:
+            self.out.flush()
+            line = await self._next()
+            if line is None:
+                return "/exit"
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            command, _, arg = line.partition(" ")
+            if command == "!sleep":
+                try:
+                    seconds = float(arg or 0)
+                except ValueError:
+                    seconds = -1
+                if not 0 <= seconds < float("inf"):
+                    self.write(f"[SCRIPT] Bad !sleep time: {arg}")
+                    continue
+                await asyncio.sleep(seconds)
+            elif command == "!wait":
+                await self._wait(arg)
+            else:
+                self.recent.clear()
+                return line
+
+    async def _wait(self, text):
+        if any(text in line for line in self.recent):
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiting = (text, future)
+        try:
+            await asyncio.wait_for(future, SCRIPT_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.write(f"[SCRIPT] Timed out waiting for: {text}")
+        finally:
+            self.waiting = None